@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Times the import of the command line interface with python -X importtime
+and fails if it has slowed, or if it has started importing one of the heavy
+dependencies which are meant to load only on the code paths using them.
+Run from the top of the repository with python -m benchmarks.bench_import
+
+The import is timed in a fresh interpreter --repeat times and the best
+cumulative time is reported, with the modules slowest to import.
+
+Usage:
+  bench_import [--module <name>] [--repeat <n>] [--top <n>]
+               [--max-ms <ms>]
+
+Options:
+  --module <name>  Module whose import is timed
+                   [default: sec_edgar_download.cli]
+  --repeat <n>     Number of timed imports, the best is reported
+                   [default: 5]
+  --top <n>        Number of the slowest modules listed [default: 10]
+  --max-ms <ms>    Fail if the best import takes longer than this many
+                   milliseconds [default: 250]
+
+"""
+
+import subprocess
+import sys
+
+from docopt import docopt
+
+# Modules the command line interface must not import at startup
+HEAVY_MODULES = ('pandas', 'numpy', 'lxml', 'bs4', 'requests', 'pyarrow')
+
+
+def import_times(module):
+    """Imports module in a fresh interpreter under -X importtime.
+
+    Returns:
+        times (dict): The self and cumulative microseconds of each module
+        imported, keyed by module name, as (self_us, cumulative_us).
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            # The header line
+            continue
+        times[fields[2].strip()] = (self_us, cumulative_us)
+    return times
+
+
+def heavy_imports(times):
+    """ Returns the heavy modules, or their submodules, in times"""
+    return sorted(name for name in times
+                  if name.split('.')[0] in HEAVY_MODULES)
+
+
+def main():
+    arguments = docopt(__doc__)
+    module = arguments['--module']
+    best = None
+    for _ in range(int(arguments['--repeat'])):
+        times = import_times(module)
+        if best is None or times[module][1] < best[module][1]:
+            best = times
+
+    print('{:<50} {:>10} {:>12}'.format('module', 'self ms', 'total ms'))
+    slowest = sorted(best.items(), key=lambda item: item[1][1], reverse=True)
+    for name, (self_us, cumulative_us) in slowest[:int(arguments['--top'])]:
+        print('{:<50} {:>10.1f} {:>12.1f}'.format(
+            name, self_us / 1000, cumulative_us / 1000))
+
+    failed = False
+    total_ms = best[module][1] / 1000
+    if total_ms > float(arguments['--max-ms']):
+        print('REGRESSION import of {} took {:.1f} ms, more than {} ms'
+              .format(module, total_ms, arguments['--max-ms']))
+        failed = True
+    heavy = heavy_imports(best)
+    if heavy:
+        print('REGRESSION import of {} loads {}'
+              .format(module, ', '.join(heavy)))
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
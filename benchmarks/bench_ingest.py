@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Compares ingesting feeds, parsing them and saving them to an empty
+database, by the row route against the DataFrame routes it replaced.
+Run from the top of the repository with python -m benchmarks.bench_ingest
+
+The routes timed are:
+  baseline   The route of the original indexer: each feed parsed whole by
+             lxml with a descendant search per field, the months
+             converted to DataFrames and joined by pd.concat(), then
+             drop_duplicates(), set_index() and to_sql(if_exists="replace"),
+             which leaves the partitions and companies tables empty
+  dataframe  The per-month DataFrame route the row route replaced: each
+             month parsed into a dict of lists, converted to a DataFrame,
+             deduplicated with drop_duplicates() and upserted by to_sql()
+  rows       Each month parsed into a list of rows, saved by
+             SecIndexer._save_rows_to_database()
+  stream     Each month's rows saved as they are parsed, never held as a
+             list
+
+Each route reports the best of --repeat timed runs, then runs once more
+under tracemalloc for its peak memory. tracemalloc sees the allocations
+made by Python and numpy, not those made within lxml or sqlite3.
+
+Usage:
+  bench_ingest [<feed-file>...] [--months <n>] [--items <n>]
+               [--repeat <n>]
+
+Options:
+  --months <n>  Months of generated feeds, when no feed-file is given
+                [default: 3]
+  --items <n>   Items in each generated feed [default: 10000]
+  --repeat <n>  Number of timed runs, the best is reported [default: 3]
+
+"""
+
+import logging
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from docopt import docopt
+from lxml import etree
+
+from sec_edgar_download import indexer
+from benchmarks.bench_suite import measure
+from benchmarks.feedgen import feed_filename, generate_feed
+
+
+def baseline_parse(ix, feed_file):
+    """The feed parsed as by the original parse_sec_rss_feeds()"""
+    root = etree.parse(feed_file).getroot()
+    items = list(root.iter('item'))
+    edgar_dict = {edgar_key: [] for edgar_key in ix.edgar_keys}
+    edgar_ns = {'edgar': indexer.EDGAR_NS}
+    for item in items:
+        for key, label in zip(ix.edgar_keys, ix.edgar_labels):
+            edgar_sub_elem = item.find('.//edgar:' + label,
+                                       namespaces=edgar_ns)
+            if edgar_sub_elem is None:
+                edgar_dict[key].append(None)
+            elif 'xbrlFiles' in edgar_sub_elem.tag:
+                xbrl_url = None
+                for xbrl_file in edgar_sub_elem.findall(
+                        './/edgar:xbrlFile', namespaces=edgar_ns):
+                    xbrl_type = xbrl_file.attrib[indexer.XBRL_TYPE_ATTR]
+                    if xbrl_type in ('EX-101.INS', 'EX-100.INS'):
+                        xbrl_url = xbrl_file.attrib[indexer.XBRL_URL_ATTR]
+                        break
+                edgar_dict[key].append(xbrl_url)
+            else:
+                edgar_dict[key].append(edgar_sub_elem.text)
+    return edgar_dict
+
+
+def baseline_ingest(ix, feed_files):
+    """The feeds parsed and saved as by the original indexer"""
+    import pandas as pd
+
+    dicts = [baseline_parse(ix, feed_file) for feed_file in feed_files]
+    db_df = pd.concat([pd.DataFrame(dic) for dic in dicts])
+    db_df.drop_duplicates('accession_number', inplace=True)
+    db_df.set_index('accession_number', inplace=True)
+    conn = sqlite3.connect(ix.database)
+    db_df.to_sql("feeds", conn, if_exists="replace", chunksize=1000)
+    conn.close()
+    return len(db_df)
+
+
+def _upsert_feed_rows(table, conn, keys, data_iter):
+    """The pandas to_sql() insertion method of the per-month route"""
+    sql = 'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+        table.name, ','.join(keys), ','.join('?' * len(keys)))
+    data = list(data_iter)
+    conn.executemany(sql, data)
+    return len(data)
+
+
+def dataframe_ingest(ix, feed_files):
+    """The feeds parsed and saved by the per-month DataFrame route"""
+    import pandas as pd
+
+    count = 0
+    for feed_file in feed_files:
+        edgar_dict = {edgar_key: [] for edgar_key in indexer.EDGAR_KEYS}
+        for record in indexer._iter_sec_rss_feed(feed_file):
+            for key in indexer.EDGAR_KEYS:
+                edgar_dict[key].append(record[key])
+
+        db_df = pd.DataFrame(edgar_dict, columns=ix.edgar_keys)
+        db_df.drop_duplicates('accession_number', inplace=True)
+        conn = sqlite3.connect(ix.database)
+        db_df.to_sql("feeds", conn, if_exists="append", index=False,
+                     chunksize=1000, method=_upsert_feed_rows)
+        months = {date[:7] for date in db_df['filing_date'] if date}
+        companies = set(zip(db_df['cik_number'], db_df['company_name']))
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO partitions (month, '
+                             'modified) VALUES (?, ?)',
+                             [(month, time.time()) for month in months])
+            conn.executemany('INSERT OR IGNORE INTO companies '
+                             '(cik_number, company_name) VALUES (?, ?)',
+                             [company for company in companies
+                              if company[1]])
+        conn.close()
+        count += len(db_df)
+    return count
+
+
+ROUTES = (
+    ('baseline', baseline_ingest),
+    ('dataframe', dataframe_ingest),
+    ('rows', lambda ix, feed_files: sum(
+        ix._save_rows_to_database(indexer._parse_sec_rss_rows(feed_file))
+        for feed_file in feed_files)),
+    ('stream', lambda ix, feed_files: sum(
+        ix._save_rows_to_database(indexer._iter_sec_rss_rows(feed_file))
+        for feed_file in feed_files)),
+)
+
+
+def main():
+    arguments = docopt(__doc__)
+    # The indexer logs each feed saved
+    logging.disable(logging.INFO)
+    work_dir = tempfile.mkdtemp()
+    try:
+        feed_files = arguments['<feed-file>']
+        if not feed_files:
+            feed_files = [
+                generate_feed(feed_filename(work_dir, 2016, month), 2016,
+                              month, int(arguments['--items']), seed=month)
+                for month in range(1, int(arguments['--months']) + 1)]
+
+        def setup():
+            return (indexer.SecIndexer(tempfile.mkdtemp(dir=work_dir)),
+                    feed_files)
+
+        print('{:<12} {:>10} {:>10} {:>12} {:>10}'.format(
+            'route', 'rows', 'seconds', 'rows/sec', 'peak MB'))
+        for route, run in ROUTES:
+            seconds, peak, rows = measure(setup, run,
+                                          int(arguments['--repeat']))
+            print('{:<12} {:>10} {:>10.3f} {:>12.0f} {:>10.1f}'.format(
+                route, rows, seconds, rows / seconds, peak / 2 ** 20))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Compares the per-item field extraction of the RSS feed parser against
+the original loop, which ran one descendant search per edgar label.
+Run from the top of the repository with python -m benchmarks.bench_parse
+
+Usage:
+  bench_parse [<feed-file>] [--items <n>] [--repeat <n>]
+
+Options:
+  --items <n>   Items in the generated feed, when no feed-file is given
+                [default: 30000]
+  --repeat <n>  Number of timed runs, the best is reported [default: 3]
+
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from docopt import docopt
+from lxml import etree
+
+from sec_edgar_download import indexer
+from benchmarks.feedgen import generate_feed
+
+
+def legacy_parse_item(ix, item):
+    """The extraction loop of the original parse_sec_rss_feeds(), with the
+    dates converted to ISO-8601 as they now are."""
+    record = {}
+    edgar_ns = {'edgar': indexer.EDGAR_NS}
+    for key, label in zip(ix.edgar_keys, ix.edgar_labels):
+        edgar_sub_elem = item.find('.//edgar:' + label, namespaces=edgar_ns)
+        if edgar_sub_elem is None:
+            record[key] = None
+        elif 'xbrlFiles' in edgar_sub_elem.tag:
+            record[key] = None
+            for xbrl_file in edgar_sub_elem.findall('.//edgar:xbrlFile',
+                                                    namespaces=edgar_ns):
+                xbrl_type = xbrl_file.attrib[indexer.XBRL_TYPE_ATTR]
+                if xbrl_type in ('EX-101.INS', 'EX-100.INS'):
+                    record[key] = xbrl_file.attrib[indexer.XBRL_URL_ATTR]
+                    break
+        else:
+            record[key] = edgar_sub_elem.text
+    record['filing_date'] = indexer._iso_date(record['filing_date'])
+    record['acceptance_datetime'] = indexer._iso_datetime(
+        record['acceptance_datetime'])
+    return record
+
+
+def best_time(func, items, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        records = [func(item) for item in items]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, records
+
+
+def main():
+    arguments = docopt(__doc__)
+    repeat = int(arguments['--repeat'])
+    work_dir = tempfile.mkdtemp()
+    try:
+        feed = arguments['<feed-file>']
+        if feed is None:
+            feed = generate_feed(os.path.join(work_dir, 'xbrlrss.xml'),
+                                 2016, 12, int(arguments['--items']))
+        ix = indexer.SecIndexer(work_dir)
+        items = list(etree.parse(feed).getroot().iter('item'))
+
+        legacy, legacy_records = best_time(
+            lambda item: legacy_parse_item(ix, item), items, repeat)
+        single, records = best_time(indexer._parse_item, items, repeat)
+        assert records == legacy_records
+
+        print('{} items in {}'.format(len(items), feed))
+        print('legacy loop:  {:10.0f} items/sec'.format(len(items) / legacy))
+        print('single pass:  {:10.0f} items/sec'.format(len(items) / single))
+        print('speedup:      {:10.2f}x'.format(legacy / single))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Compares the memory held by several months of parsed feeds in each of
+the forms the parser returns them, against the form the original parser
+returned them in, holding a string of their own for every field.
+Run from the top of the repository with python -m benchmarks.bench_records
+
+The forms measured are:
+  original columns  A dict of lists per month, holding strings of their
+                    own, as returned by the original parse_sec_rss_feeds()
+  records           A dict per filing, SecIndexer.iter_sec_rss_feed()
+  columns           A dict of lists per month,
+                    SecIndexer.parse_sec_rss_feeds()
+  filings           A Filing per filing, SecIndexer.parse_sec_rss_rows()
+
+The original columns are parsed by the original parser's extraction loop,
+see benchmarks.bench_parse, which leaves every field a string of its own.
+
+The memory held is that traced by tracemalloc once the months have been
+parsed, and so left out of it are any transient allocations.
+
+Usage:
+  bench_records [--months <n>] [--items <n>]
+
+Options:
+  --months <n>  Months of generated feeds held in memory [default: 6]
+  --items <n>   Items in each generated feed [default: 5000]
+
+"""
+
+import gc
+import logging
+import shutil
+import tempfile
+import tracemalloc
+
+from docopt import docopt
+from lxml import etree
+
+from sec_edgar_download import indexer
+from benchmarks.bench_parse import legacy_parse_item
+from benchmarks.feedgen import feed_filename, generate_feed
+
+
+def original_columns(ix, feed_file):
+    """The dict of lists of a feed, holding strings of their own"""
+    edgar_dict = {edgar_key: [] for edgar_key in ix.edgar_keys}
+    for _, item in etree.iterparse(feed_file, events=('end',), tag='item'):
+        record = legacy_parse_item(ix, item)
+        item.clear()
+        for key in ix.edgar_keys:
+            edgar_dict[key].append(record[key])
+    return edgar_dict
+
+
+def held_bytes(parse, feed_files):
+    """Parses each of the feed files, as parse(feed_file), and returns the
+    bytes allocated by Python which are held by the parsed feeds.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        parsed = [parse(feed_file) for feed_file in feed_files]
+        gc.collect()
+        held, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del parsed
+    return held
+
+
+def main():
+    arguments = docopt(__doc__)
+    months, items = int(arguments['--months']), int(arguments['--items'])
+    # The indexer logs each feed parsed
+    logging.disable(logging.INFO)
+    work_dir = tempfile.mkdtemp()
+    try:
+        ix = indexer.SecIndexer(work_dir)
+        feed_files = [generate_feed(feed_filename(work_dir, 2016, month),
+                                    2016, month, items, seed=month)
+                      for month in range(1, months + 1)]
+        forms = (
+            ('original columns', lambda feed_file: original_columns(
+                ix, feed_file)),
+            ('records', lambda feed_file: list(
+                ix.iter_sec_rss_feed(feed_file))),
+            ('columns', ix.parse_sec_rss_feeds),
+            ('filings', ix.parse_sec_rss_rows),
+        )
+
+        filings = months * items
+        baseline = None
+        print('{} filings in {} months'.format(filings, months))
+        print('{:<20} {:>10} {:>14} {:>16}'.format(
+            'form', 'held MB', 'bytes/filing', 'vs original'))
+        for form, parse in forms:
+            held = held_bytes(parse, feed_files)
+            baseline = baseline or held
+            print('{:<20} {:>10.1f} {:>14.0f} {:>15.1f}x'.format(
+                form, held / 2 ** 20, held / filings, baseline / held))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
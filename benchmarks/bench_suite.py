@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Times the hot paths of the indexer on generated feeds and reports any
+regression against a baseline saved by an earlier run.
+Run from the top of the repository with python -m benchmarks.bench_suite
+
+The stages timed are:
+  parse   SecIndexer.parse_sec_rss_feeds() of a generated feed
+  save    SecIndexer._save_dicts_to_database() of the parsed feed, into an
+          empty database
+  select  SecIndexer._select_xbrl_urls(), the query run by
+          download_xbrl_data(), for a batch of CIKs
+
+Each stage reports the best of --repeat timed runs, then runs once more
+under tracemalloc for its peak memory. tracemalloc sees the allocations
+made by Python, not those made within lxml or sqlite3.
+
+Usage:
+  bench_suite [--items <n>...] [--missing <fraction>] [--ciks <n>]
+              [--repeat <n>] [--output <json>] [--baseline <json>]
+              [--tolerance <fraction>]
+
+Options:
+  --items <n>             Items in the generated feed, repeat the option to
+                          time several sizes [default: 1000 10000]
+  --missing <fraction>    Fraction of items with a field missing
+                          [default: 0.05]
+  --ciks <n>              CIKs selected by the select stage [default: 100]
+  --repeat <n>            Number of timed runs, the best is reported
+                          [default: 3]
+  --output <json>         Save the results to this file
+  --baseline <json>       Results of an earlier run to compare against
+  --tolerance <fraction>  Slow down, or growth in peak memory, allowed
+                          before a stage is reported as a regression
+                          [default: 0.2]
+
+"""
+
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from docopt import docopt
+
+from sec_edgar_download import indexer
+from benchmarks.feedgen import feed_filename, generate_feed
+
+YEAR, MONTH = 2016, 12
+
+
+def measure(setup, run, repeat):
+    """Times run(*setup()), the setup is not timed.
+
+    Returns:
+        (seconds, peak_bytes, rows) (tuple): The best time of `repeat` runs,
+        the peak memory traced during one more run and the number of rows
+        run returned.
+    """
+    best = None
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        rows = run(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    args = setup()
+    tracemalloc.start()
+    try:
+        run(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak, rows
+
+
+def bench_size(work_dir, items, missing, ciks, repeat):
+    """Times each stage on a feed of `items` items.
+
+    Returns:
+        results (dict): The results of each stage, keyed by stage[items].
+    """
+    feed = generate_feed(feed_filename(work_dir, YEAR, MONTH), YEAR, MONTH,
+                         items, missing=missing)
+    runs = []
+
+    def new_indexer():
+        return indexer.SecIndexer(tempfile.mkdtemp(dir=work_dir))
+
+    ix = new_indexer()
+    runs.append(('parse', lambda: (ix, feed),
+                 lambda ix, feed: len(
+                     ix.parse_sec_rss_feeds(feed)['accession_number'])))
+
+    edgar_dict = ix.parse_sec_rss_feeds(feed)
+
+    def save(ix, edgar_dict):
+        ix._save_dicts_to_database([edgar_dict])
+        return len(edgar_dict['accession_number'])
+
+    runs.append(('save', lambda: (new_indexer(), edgar_dict), save))
+
+    ix._save_dicts_to_database([edgar_dict])
+    batch = range(1000, 1000 + ciks)
+    runs.append(('select', lambda: (ix, batch),
+                 lambda ix, batch: len(
+                     ix._select_xbrl_urls(batch, YEAR, YEAR))))
+
+    results = {}
+    for stage, setup, run in runs:
+        seconds, peak, rows = measure(setup, run, repeat)
+        results['{}[{}]'.format(stage, items)] = {
+            'items': items, 'rows': rows, 'seconds': seconds,
+            'rows_per_sec': rows / seconds, 'peak_bytes': peak}
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """Compares results against a baseline.
+
+    Returns:
+        found (list): A description of each stage which has slowed down, or
+        whose peak memory has grown, by more than the tolerance.
+    """
+    found = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['rows_per_sec'] < base['rows_per_sec'] * (1 - tolerance):
+            found.append('{}: {:.0f} rows/sec, was {:.0f}'.format(
+                name, result['rows_per_sec'], base['rows_per_sec']))
+        if result['peak_bytes'] > base['peak_bytes'] * (1 + tolerance):
+            found.append('{}: peak {:.1f} MB, was {:.1f} MB'.format(
+                name, result['peak_bytes'] / 2 ** 20,
+                base['peak_bytes'] / 2 ** 20))
+    return found
+
+
+def main():
+    arguments = docopt(__doc__)
+    # The indexer logs each feed parsed and saved
+    logging.disable(logging.INFO)
+    work_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for items in arguments['--items']:
+            results.update(bench_size(
+                work_dir, int(items), float(arguments['--missing']),
+                int(arguments['--ciks']), int(arguments['--repeat'])))
+    finally:
+        shutil.rmtree(work_dir)
+
+    print('{:<20} {:>10} {:>14} {:>12}'.format(
+        'stage', 'rows', 'rows/sec', 'peak MB'))
+    for name, result in sorted(results.items()):
+        print('{:<20} {:>10} {:>14.0f} {:>12.1f}'.format(
+            name, result['rows'], result['rows_per_sec'],
+            result['peak_bytes'] / 2 ** 20))
+
+    if arguments['--output']:
+        with open(arguments['--output'], 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'created': time.time(), 'results': results},
+                      f, indent=2, sort_keys=True)
+
+    if arguments['--baseline'] and os.path.exists(arguments['--baseline']):
+        with open(arguments['--baseline']) as f:
+            baseline = json.load(f)['results']
+        found = regressions(results, baseline,
+                            float(arguments['--tolerance']))
+        for regression in found:
+            print('REGRESSION ' + regression)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Generates synthetic Edgar xbrlrss-YYYY-MM.xml feeds for benchmarking.
+
+The generated feeds follow the layout of the monthly feeds published at
+https://www.sec.gov/Archives/edgar/monthly/ so that they can be parsed by
+SecIndexer.parse_sec_rss_feeds() without any network access. Each filing
+lists several xbrlFile entries, and a fraction of the filings may be
+generated with fields missing, as some real filings are.
+Run from the top of the repository with python -m benchmarks.feedgen
+
+Usage:
+  feedgen <dir> <year> <month> [--items <n>] [--missing <fraction>]
+                               [--seed <n>]
+
+Options:
+  --items <n>             Items in the feed [default: 10000]
+  --missing <fraction>    Fraction of items with a field missing
+                          [default: 0.05]
+  --seed <n>              Seed for the random number generator [default: 0]
+
+"""
+
+import os
+import random
+
+from docopt import docopt
+
+FORM_TYPES = ('10-Q', '10-K', '8-K', '10-Q/A', '10-K/A', '20-F', '40-F',
+              '6-K', 'S-1', 'S-4')
+SICS = ('3674', '6022', '2834', '7372', '1311', '6798', '3841', '4911')
+DIRECTORS = ('Office of Manufacturing', 'Office of Financial Services',
+             'Office of Life Sciences', 'Office of Technology',
+             'Office of Energy &amp; Transportation', 'Office of Real Estate')
+
+MONTHLY_URL = 'http://www.sec.gov/Archives/edgar/monthly/'
+
+HEADER = '''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom">
+<channel>
+<title>All XBRL Data Submitted to the SEC for {period}</title>
+<link>{monthly}xbrlrss-{period}.xml</link>
+<description>This is a list of all XBRL filings for {period}</description>
+<language>en-us</language>
+'''
+
+ITEM = '''<item>
+<title>{name} ({cik}) (Filer)</title>
+<link>{base}/{accession}-index.htm</link>
+<guid>{base}/{accession}.xbrl.zip</guid>
+<enclosure url="{base}/{accession}.xbrl.zip" length="{length}"
+  type="application/zip" />
+<description>{form}</description>
+<pubDate>{pub_date}</pubDate>
+<edgar:xbrlFiling xmlns:edgar="http://www.sec.gov/Archives/edgar">
+<edgar:companyName>{name}</edgar:companyName>
+<edgar:formType>{form}</edgar:formType>
+<edgar:filingDate>{month:02}/{day:02}/{year}</edgar:filingDate>
+<edgar:cikNumber>{cik}</edgar:cikNumber>
+<edgar:accessionNumber>{accession}</edgar:accessionNumber>
+<edgar:fileNumber>{file_number}</edgar:fileNumber>
+<edgar:acceptanceDatetime>{year}{month:02}{day:02}{hms}</edgar:acceptanceDatetime>
+<edgar:period>{period}</edgar:period>
+<edgar:assistantDirector>{director}</edgar:assistantDirector>
+<edgar:assignedSic>{sic}</edgar:assignedSic>
+<edgar:fiscalYearEnd>{fye}</edgar:fiscalYearEnd>
+<edgar:xbrlFiles>
+{files}</edgar:xbrlFiles>
+</edgar:xbrlFiling>
+</item>
+'''
+
+XBRL_FILE = ('<edgar:xbrlFile edgar:sequence="{seq}" edgar:file="{name}" '
+             'edgar:type="{type}" edgar:size="{size}" '
+             'edgar:description="{type} document" edgar:url="{base}/{name}" />'
+             '\n')
+
+SUFFIXES = (('EX-101.SCH', '.xsd'), ('EX-101.CAL', '_cal.xml'),
+            ('EX-101.DEF', '_def.xml'), ('EX-101.LAB', '_lab.xml'),
+            ('EX-101.PRE', '_pre.xml'))
+
+# The elements which may be left out of an item, as they are from some
+# filings in the real feeds
+OPTIONAL_TAGS = ('fileNumber', 'period', 'assistantDirector', 'assignedSic',
+                 'fiscalYearEnd', 'xbrlFiles')
+
+
+def feed_filename(directory, year, month):
+    """Returns the name of the feed for year and month in directory"""
+    return os.path.join(directory,
+                        'xbrlrss-{}-{:02}.xml'.format(year, month))
+
+
+def _drop_tag(item, tag):
+    """Removes the edgar:tag element, on one or more lines, from an item"""
+    start = item.index('<edgar:' + tag + '>')
+    end = item.index('</edgar:' + tag + '>') + len(tag) + 10
+    return item[:start] + item[end:]
+
+
+def generate_feed(filename, year, month, items, seed=0,
+                  url_base='http://www.sec.gov', missing=0.0):
+    """Writes a synthetic feed containing `items` filings to filename.
+
+    Args:
+        filename (str): Where to write the feed.
+        year (int): The year of the feed.
+        month (int): The month of the feed.
+        items (int): The number of <item> elements to generate.
+        seed (int): Seed for the random number generator.
+        url_base (str): Scheme and host used for the filing URLs.
+        missing (float): The fraction of items generated with one of the
+            OPTIONAL_TAGS left out.
+
+    Returns:
+        filename (str)
+    """
+    rng = random.Random(seed)
+    companies = max(1, items // 3)
+    with open(filename, 'w') as feed:
+        feed.write(HEADER.format(monthly=MONTHLY_URL,
+                                 period='{}-{:02}'.format(year, month)))
+        for n in range(items):
+            company = rng.randrange(companies)
+            cik = '{:010d}'.format(1000 + company)
+            accession = '{}-{:02}-{:06d}'.format(cik, year % 100, n)
+            ticker = 'co{}'.format(company)
+            period = '{}{:02}{:02}'.format(year, rng.randint(1, 12), 28)
+            base = '{}/Archives/edgar/data/{}/{}'.format(
+                url_base, int(cik), accession.replace('-', ''))
+            instance = '{}-{}.xml'.format(ticker, period)
+            files = [XBRL_FILE.format(seq=1, name=instance, type='EX-101.INS',
+                                      size=rng.randint(10 ** 5, 10 ** 7),
+                                      base=base)]
+            for seq, (xbrl_type, suffix) in enumerate(SUFFIXES, 2):
+                files.append(XBRL_FILE.format(
+                    seq=seq, name='{}-{}{}'.format(ticker, period, suffix),
+                    type=xbrl_type, size=rng.randint(10 ** 4, 10 ** 6),
+                    base=base))
+            # The instance document is not always listed first
+            files.insert(rng.randrange(len(files)), files.pop(0))
+            day = rng.randint(1, 28)
+            item = ITEM.format(
+                name='COMPANY {} INC'.format(company), cik=cik,
+                accession=accession, base=base,
+                length=rng.randint(10 ** 4, 10 ** 7),
+                form=rng.choice(FORM_TYPES),
+                pub_date='{:02} Jan {} 16:14:54 EST'.format(day, year),
+                year=year, month=month, day=day,
+                file_number='000-{:05d}'.format(company),
+                hms='{:02}{:02}{:02}'.format(rng.randint(6, 21),
+                                             rng.randint(0, 59),
+                                             rng.randint(0, 59)),
+                period=period, director=rng.choice(DIRECTORS),
+                sic=rng.choice(SICS), fye='{:02}{:02}'.format(
+                    rng.randint(1, 12), 28 + rng.randint(0, 3) % 3),
+                files=''.join(files))
+            if missing and rng.random() < missing:
+                item = _drop_tag(item, rng.choice(OPTIONAL_TAGS))
+            feed.write(item)
+        feed.write('</channel>\n</rss>\n')
+    return filename
+
+
+def main():
+    arguments = docopt(__doc__)
+    year, month = int(arguments['<year>']), int(arguments['<month>'])
+    if not os.path.isdir(arguments['<dir>']):
+        os.makedirs(arguments['<dir>'])
+    filename = generate_feed(
+        feed_filename(arguments['<dir>'], year, month), year, month,
+        int(arguments['--items']), seed=int(arguments['--seed']),
+        missing=float(arguments['--missing']))
+    print(filename)
+
+
+if __name__ == '__main__':
+    main()
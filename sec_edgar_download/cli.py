@@ -8,8 +8,22 @@
 Usage:
   sec_edgar_download getrss <from-year> <to-year> [--fm <from-month>]
                                         [--tm <to-month] [--wd <dir>]
+                                        [--jobs <n>] [--refresh] [--force]
+                                        [--compress <type>] [--metrics <file>]
+                                        [--profile <file>]
   sec_edgar_download getxbrl <from-year> <to-year> (-c  <cik> | -t <ticker> | -f <file>)
                                         [--ft <form-type>]  [--wd <dir>]
+                                        [--jobs <n>] [--compress <type>]
+                                        [--metrics <file>] [--profile <file>]
+  sec_edgar_download ingest [<from-year> <to-year>] [--fm <from-month>]
+                                        [--tm <to-month] [--wd <dir>]
+                                        [--rss-dir <dir>] [--jobs <n>]
+                                        [--force] [--metrics <file>]
+                                        [--profile <file>]
+  sec_edgar_download loadciks <tickers-json> [--wd <dir>]
+  sec_edgar_download compress [--compress <type>] [--wd <dir>]
+  sec_edgar_download export [<export-dir>] [--full] [--wd <dir>]
+  sec_edgar_download search <query> [--limit <n>] [--wd <dir>]
 
   sec_edgar_download.py (-h | --help)
   sec_edgar_download.py --version
@@ -19,15 +33,33 @@ Options:
   -c --cik <cik>        Central Index Key (CIK)
   -t --ticker <ticker>  Ticker symbol
   -f --file <file>      File containing tickers
+  <tickers-json>        A copy of the SEC's company_tickers.json
   --version             Show version.
   --fm <from-month>     From month: digits 1 to 12
   --tm <to-month>       To month: digits 1 to 12
   --ft <form-type>      10-K or 10-Q
   --wd <dir>            Working-directory  [default : ./edgar]
+  --jobs <n>            Most concurrent downloads, up to 8, within
+                        which they adapt to how fast the SEC serves
+                        them, or number of parsing processes for ingest
+  --refresh             Refresh the feeds of open months, if changed
+  --force               Parse feeds even if unchanged since last parsed
+  --compress <type>     Store downloads compressed: gzip or zstd
+  --rss-dir <dir>       Directory of xbrlrss-YYYY-MM.xml feeds to ingest
+                        [default : <dir>/rss-archives]
+  <export-dir>          Directory to export Parquet files to
+                        [default : <dir>/parquet]
+  --full                Export every month, not only those changed
+  --limit <n>           Number of companies to list  [default: 10]
+  --metrics <file>      Write the timings of each stage, as JSON or, if
+                        the file ends in .prom, a Prometheus textfile
+  --profile <file>      Write cProfile statistics for the run
 
 """
 # the imports have to be under the docstring
 # otherwise the docopt module does not work.
+import logging
+
 from docopt import docopt
 from sec_edgar_download import indexer as ix 
 
@@ -35,29 +67,88 @@ from sec_edgar_download import indexer as ix
 def main(args=None):
     arguments = docopt(__doc__, version='sec_edgar_download 0.1.2')
     print(arguments)
-
-    from_year = int(arguments['<from-year>'])
-    to_year = int(arguments['<to-year>'])
+    logging.basicConfig(level=logging.INFO)
+
+    profile = arguments['--profile']
+    if profile is None:
+        indexer = _run(arguments)
+    else:
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        indexer = profiler.runcall(_run, arguments)
+        profiler.dump_stats(profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+    if arguments['--metrics']:
+        indexer.metrics.write(arguments['--metrics'])
+
+
+def _run(arguments):
+    """ Runs the command given by the parsed arguments, returning the
+    SecIndexer it ran with.
+    """
+    from_year = arguments['<from-year>']
+    if from_year is not None:
+        from_year = int(from_year)
+    to_year = arguments['<to-year>']
+    if to_year is not None:
+        to_year = int(to_year)
 
     work_dir = arguments['--wd']
     if work_dir is None:
         work_dir = './edgar'
 
+    jobs = arguments['--jobs']
+    if jobs is not None:
+        jobs = int(jobs)
+
+    from_month = arguments['--fm']
+    if from_month is not None:
+        from_month = int(from_month)
+    else:
+        from_month = 1
+
+    to_month = arguments['--tm']
+    if to_month is not None:
+        to_month = int(to_month)
+    else:
+        to_month = 12
+
+    compression = arguments['--compress']
+
     if arguments['getrss']:
-        from_month = arguments['--fm']
-        if from_month is not None:
-            from_month = int(from_month)
-        else:
-            from_month = 1
+        indexer = ix.SecIndexer(work_dir, jobs=jobs,
+                                compression=compression)
+        indexer.download_sec_feeds(from_year, to_year, from_month, to_month,
+                                   refresh=arguments['--refresh'],
+                                   force=arguments['--force'])
 
-        to_month = arguments['--tm']
-        if to_month is not None:
-            to_month = int(to_month)
-        else:
-            to_month = 12
+    elif arguments['ingest']:
+        indexer = ix.SecIndexer(work_dir)
+        indexer.ingest_sec_feeds(from_year, to_year, from_month, to_month,
+                                 rss_dir=arguments['--rss-dir'], jobs=jobs,
+                                 force=arguments['--force'])
+
+    elif arguments['compress']:
+        indexer = ix.SecIndexer(work_dir)
+        indexer.compress_work_dir(compression)
+
+    elif arguments['export']:
+        indexer = ix.SecIndexer(work_dir)
+        indexer.export_feeds(arguments['<export-dir>'],
+                             full=arguments['--full'])
+
+    elif arguments['search']:
+        indexer = ix.SecIndexer(work_dir)
+        for cik, name in indexer.search_companies(
+                arguments['<query>'], int(arguments['--limit'])):
+            print(cik, name)
 
+    elif arguments['loadciks']:
         indexer = ix.SecIndexer(work_dir)
-        indexer.download_sec_feeds(from_year, to_year, from_month, to_month)
+        indexer.load_company_tickers(arguments['<tickers-json>'])
 
     elif arguments['getxbrl']:
         form_type = arguments['--ft']
@@ -69,21 +160,26 @@ def main(args=None):
             cik = arguments['--cik']
             if cik is not None:
                 cik = int(cik)
+            indexer = ix.SecIndexer(work_dir, jobs=jobs,
+                                    compression=compression)
             ticker = arguments['--ticker']
             if ticker is not None:
-                cik = ix.get_cik(ticker)
+                cik = indexer.get_cik(ticker)
 
-            indexer = ix.SecIndexer(work_dir)
             indexer.download_xbrl_data(cik, from_year, to_year, form_type)
         else:
             with open(file) as t_file:
-                for line in t_file: # Each line contains a ticker
-                    print("\nTicker =",line)
-                    cik = ix.get_cik(line)
-                    indexer = ix.SecIndexer(work_dir)
-                    indexer.download_xbrl_data(cik, from_year, to_year, form_type)
+                # Each line contains a ticker
+                tickers = [line.strip() for line in t_file if line.strip()]
+            print("\nTickers =", ' '.join(tickers))
+            indexer = ix.SecIndexer(work_dir, jobs=jobs,
+                                    compression=compression)
+            ciks = indexer.get_ciks(tickers)
+            indexer.download_xbrl_batch(ciks.values(), from_year, to_year,
+                                        form_type)
+
+    return indexer
 
-        
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,384 @@
+"""This module provides an asyncio based engine for downloading many files
+from the SEC edgar website concurrently, while keeping the rate of requests
+within the limit set by the SEC's fair access policy, and backing off when
+the SEC throttles them.
+
+:copyright: (c) 2017 by Robert Rennison
+:license: Apache 2, see LICENCE for more details
+"""
+
+import collections
+import functools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sec_edgar_download import storage
+
+# asyncio, email and requests are slow to import, so they are imported only
+# once they are needed, by the functions using them
+
+logger = logging.getLogger(__name__)
+
+# The SEC asks that automated tools make no more than 10 requests per second
+# https://www.sec.gov/developer
+SEC_REQUESTS_PER_SECOND = 10
+
+# Downloads are streamed to disk in chunks of this many bytes
+CHUNK_SIZE = 64 * 1024
+
+# The HTTP statuses with which the SEC throttles requests, and those worth
+# retrying
+THROTTLE_STATUSES = (429, 503)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# The outcome of a download. size, sha256 and the etag and last_modified
+# HTTP validators describe the file written, error is set, and they are
+# None, if the download failed.
+DownloadResult = collections.namedtuple(
+    'DownloadResult', 'url filename error size sha256 etag last_modified')
+
+
+class TokenBucket():
+    """A token bucket rate limiter.
+
+    Tokens are added to the bucket at `rate` per second, up to `capacity`,
+    and every request takes one. A single bucket may be shared by threads
+    and by coroutines, with acquire() blocking a thread and wait() suspending
+    a coroutine, until the request is allowed.
+
+    Args:
+        rate (float): The sustained number of requests per second.
+        capacity (int): The largest burst of requests allowed, defaults to
+            one second's worth of requests.
+    """
+    def __init__(self, rate=SEC_REQUESTS_PER_SECOND, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """ Takes a token, returning how long to wait until it is due"""
+        with self._lock:
+            now = time.monotonic()
+            refill = (now - self._updated) * self.rate
+            self._tokens = min(self.capacity, self._tokens + refill)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """ Blocks the calling thread until a request is allowed"""
+        delay = self._reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def wait(self):
+        """ Suspends the calling coroutine until a request is allowed"""
+        import asyncio
+
+        delay = self._reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+def _retry_after(response):
+    """ Returns the seconds to wait given by a response's Retry-After header,
+    as a number of seconds or an HTTP date, or None.
+    """
+    # A requests.Response is falsy when its status is an error
+    if response is None:
+        return None
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at - time.time())
+
+
+class RequestScheduler():
+    """Schedules requests to the SEC, adapting to how fast it will serve them
+
+    A request runs only once it has a token from the rate limiter and one of
+    `limit` concurrency slots. Failed requests are retried after a
+    jittered exponential backoff, or after the delay the SEC gives in a
+    Retry-After header, during which every request waits.
+
+    The concurrency limit follows an additive increase, multiplicative
+    decrease (AIMD) rule: each successful request raises it by 1 / limit,
+    about one more slot for each limit's worth of successes, while a
+    throttled (429 or 503) response halves it. The limit is not raised by
+    requests taking more than latency_factor times as long as the quickest
+    seen. A single scheduler may be shared by the threads and coroutines
+    making feed, filing and CIK requests.
+
+    Args:
+        limiter (TokenBucket): The rate limiter to take tokens from,
+            defaults to a new limiter allowing SEC_REQUESTS_PER_SECOND.
+        max_concurrency (int): The highest, and initial, concurrency limit.
+        min_concurrency (int): The lowest concurrency limit.
+    """
+    # Retries of a failed request
+    retries = 4
+    # Seconds of backoff before the first retry, doubled for each retry,
+    # up to max_backoff
+    backoff = 1.0
+    max_backoff = 60.0
+    # Multiple of the quickest request time beyond which requests are slow,
+    # requests quicker than min_slow seconds never are
+    latency_factor = 4.0
+    min_slow = 1.0
+
+    def __init__(self, limiter=None, max_concurrency=8, min_concurrency=1):
+        self.limiter = limiter or TokenBucket()
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.retried = 0
+        self.throttled = 0
+        self.min_latency = None
+        self._paused_until = 0.0
+        self._decreased = float('-inf')
+        self._condition = threading.Condition()
+
+    def _acquire(self):
+        with self._condition:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause <= 0 and self.in_flight < int(self.limit):
+                    break
+                self._condition.wait(pause if pause > 0 else None)
+            self.in_flight += 1
+        self.limiter.acquire()
+
+    def _release(self, start, latency=None, throttled=False,
+                 retry_after=None):
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttled += 1
+                # Halve the limit once for the requests in flight together,
+                # those started before the last decrease are not counted
+                if start > self._decreased:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self._decreased = now
+                    logger.info('Throttled, concurrency limit now %d',
+                                int(self.limit))
+                if retry_after:
+                    self._paused_until = max(self._paused_until,
+                                             now + retry_after)
+            elif latency is not None:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                if latency <= max(self.min_slow,
+                                  self.min_latency * self.latency_factor):
+                    self.limit = min(self.max_concurrency,
+                                     self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def _backoff(self, attempt):
+        """ Returns a jittered delay before retry number `attempt`"""
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def run(self, func, *args, **kwargs):
+        """Makes a request, func(*args, **kwargs), retrying it if it fails
+
+        Blocks the calling thread while waiting for a slot, a token or a
+        retry. Requests failing with a status in RETRY_STATUSES, a dropped
+        connection or a timeout are retried, other failures are not.
+
+        Returns:
+            result: The value returned by func.
+
+        Raises:
+            requests.exceptions.RequestException: If the last attempt failed.
+        """
+        import requests
+
+        attempt = 0
+        while True:
+            self._acquire()
+            start = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except requests.exceptions.HTTPError as err:
+                failure = err
+                status = getattr(err.response, 'status_code', None)
+                retry_after = _retry_after(err.response)
+                self._release(start, throttled=status in THROTTLE_STATUSES,
+                              retry_after=retry_after)
+                if status not in RETRY_STATUSES or attempt >= self.retries:
+                    raise
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as err:
+                failure = err
+                retry_after = None
+                self._release(start)
+                if attempt >= self.retries:
+                    raise
+            except BaseException:
+                self._release(start)
+                raise
+            else:
+                self._release(start, time.monotonic() - start)
+                return result
+
+            delay = self._backoff(attempt)
+            if retry_after is not None:
+                delay = retry_after
+            logger.info('Retrying after %s, in %.1f seconds', failure, delay)
+            with self._condition:
+                self.retried += 1
+            time.sleep(delay)
+            attempt += 1
+
+
+def fetch_file(session, url, filename, etag=None, last_modified=None,
+               timeout=None, compression=None):
+    """Downloads a single file, conditionally when validators are given
+
+    When the etag or last_modified HTTP validators of a previous download
+    are given the request is a conditional GET, and a file which has not
+    changed since is neither transferred nor rewritten.
+
+    The response is streamed, as raw bytes, to a temporary file alongside
+    filename which is renamed into place only once it is complete. Memory
+    use does not depend on the size of the file, and a failed download
+    never leaves a truncated file behind. The file may be stored compressed,
+    see the storage module.
+
+    Args:
+        session (requests.Session): The session to make the request with.
+        url (str): The URL of the file.
+        filename (str): Where to write the file, including any compression
+            suffix.
+        etag (str): The ETag of the previous download, if any.
+        last_modified (str): The Last-Modified of the previous download.
+        timeout (float): The requests timeout, in seconds.
+        compression (str): How to compress the file, 'gzip', 'zstd' or None.
+
+    Returns:
+        result (DownloadResult): The file written, or None if the server
+        reported that the file was not modified. The size and sha256 are
+        those of the file as stored.
+
+    Raises:
+        requests.exceptions.RequestException: If the request failed or the
+        server responded with an HTTP error status.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    response = session.get(url, headers=headers, timeout=timeout,
+                           stream=True)
+    try:
+        response.raise_for_status()
+        if response.status_code == 304:
+            return None
+
+        size, sha256 = storage.write_file(
+            filename, response.iter_content(CHUNK_SIZE), compression)
+    finally:
+        response.close()
+
+    return DownloadResult(url, filename, None, size, sha256,
+                          response.headers.get('ETag'),
+                          response.headers.get('Last-Modified'))
+
+
+async def _download(loop, executor, semaphore, scheduler, session,
+                    url, filename, compression, metrics):
+    import requests
+
+    async with semaphore:
+        logger.info('Downloading file %s to %s', url, filename)
+        start = time.monotonic()
+        try:
+            result = await loop.run_in_executor(
+                executor, functools.partial(scheduler.run, fetch_file,
+                                            session, url, filename,
+                                            compression=compression))
+        except (requests.exceptions.RequestException, OSError) as err:
+            logger.error('Failed to download %s: %s', url, err)
+            result = DownloadResult(url, filename, err, None, None, None,
+                                    None)
+        if metrics is not None:
+            metrics.record('filing_download', time.monotonic() - start,
+                           items=1, nbytes=result.size or 0,
+                           error=result.error is not None)
+        return result
+
+
+async def download_files_async(session, downloads, concurrency=4,
+                               limiter=None, compression=None,
+                               scheduler=None, metrics=None):
+    """Downloads files concurrently from within a running event loop
+
+    Coroutine version of download_files(), for callers, such as Jupyter
+    notebooks, which already have a running asyncio event loop.
+    """
+    import asyncio
+
+    scheduler = scheduler or RequestScheduler(limiter, concurrency)
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return await asyncio.gather(*[
+            _download(loop, executor, semaphore, scheduler, session,
+                      url, filename, compression, metrics)
+            for url, filename in downloads])
+
+
+def download_files(session, downloads, concurrency=4, limiter=None,
+                   compression=None, scheduler=None, metrics=None):
+    """Downloads files concurrently, within the SEC's request rate limit
+
+    No more than `concurrency` downloads are in flight at any time, and
+    every request is made through `scheduler`, which takes a token from its
+    rate limiter, so that the rate of requests across all of the downloads
+    in flight stays within the limit, and retries requests the SEC fails or
+    throttles. A download which still fails is logged and reported in its
+    result; it does not stop the others.
+
+    Args:
+        session (requests.Session): The session to make the requests with.
+        downloads (iterable): (url, filename) pairs of the files to download.
+        concurrency (int): The largest number of downloads in flight.
+        limiter (TokenBucket): The rate limiter to share, defaults to a new
+            limiter allowing SEC_REQUESTS_PER_SECOND.
+        compression (str): How to compress the files, see fetch_file().
+        scheduler (RequestScheduler): The scheduler to share, defaults to a
+            new scheduler using limiter.
+        metrics (metrics.Metrics): Where to record the time taken, and bytes
+            stored, by each download, as the filing_download stage.
+
+    Returns:
+        results (list): A DownloadResult for each download, in order, with
+        error set to the exception raised by a failed download.
+    """
+    import asyncio
+
+    return asyncio.run(download_files_async(session, downloads, concurrency,
+                                            limiter, compression, scheduler,
+                                            metrics))
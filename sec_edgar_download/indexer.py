@@ -10,48 +10,296 @@ import os.path
 import sqlite3 as sqlite3
 import logging
 import re
-import pandas as pd
-from lxml import etree
-import requests
-from bs4 import BeautifulSoup
+import hashlib
+import json
+import time
+import collections
+import sys
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sec_edgar_download import downloader, metrics, storage
 
+# pandas, lxml, requests, bs4 and multiprocessing are slow to import, so
+# each is imported by the functions using it, keeping the CLI quick to start,
+# for --help or a search, say.
 
-def get_cik(ticker):
+logger = logging.getLogger(__name__)
+
+
+# The edgar website, which may be replaced by a mirror or a local stand-in
+SEC_BASE_URL = 'https://www.sec.gov'
+
+
+def get_cik(ticker, base_url=SEC_BASE_URL, session=None):
     """ Query the edgar site for the cik corresponding to a ticker.
     Returns a string representing the cik.
     By using the xml output format in the query and BeautifulSoup
     the parsing of the cik from the response is simple; avoiding
     the need for regexps
+
+    The query is made to base_url, through session when one is given.
+    Raises ValueError if the response holds no CIK, as for an unknown
+    ticker.
     """
+    import requests
+    from bs4 import BeautifulSoup
 
-    url = 'https://www.sec.gov/cgi-bin/browse-edgar'
+    url = base_url + '/cgi-bin/browse-edgar'
     query_args = {'CIK': ticker, 'action': 'getcompany', 'output': 'xml'}
-    response = requests.get(url, params=query_args)
+    response = (session or requests).get(url, params=query_args)
+    response.raise_for_status()
     soup = BeautifulSoup(response.text, 'lxml')
+    if soup.cik is None:
+        raise ValueError('No CIK found on edgar for ticker {}'.format(ticker))
     return soup.cik.get_text()
 
 
-def _parse_xbrlfiles(edgar_sub_elem, edgar_ns, item):
+EDGAR_NS = 'http://www.sec.gov/Archives/edgar'
+XBRL_FILING_TAG = '{' + EDGAR_NS + '}xbrlFiling'
+XBRL_FILE_TAG = '{' + EDGAR_NS + '}xbrlFile'
+XBRL_TYPE_ATTR = '{' + EDGAR_NS + '}type'
+XBRL_URL_ATTR = '{' + EDGAR_NS + '}url'
+
+# Columns of few distinct values, exported as categoricals
+CATEGORICAL_KEYS = ('form_type', 'assigned_sic', 'assistant_director')
+
+# The version of the edgar.db schema, see SecIndexer._prep_database_table()
+SCHEMA_VERSION = 5
+
+FEED_FILENAME_RE = re.compile(r'^xbrlrss-(\d{4})-(\d{2})\.xml(\.gz|\.zst)?$')
+
+
+def _format_cik(cik):
+    """ Formats a CIK, given as an int or a str, as the zero padded ten digit
+    str used by the RSS feeds and so by the feeds table.
+    """
+    return '{:010d}'.format(int(cik))
+
+
+def _format_ticker(ticker):
+    """ Formats a ticker, as read from a file or typed, for the ciks table"""
+    return ticker.strip().upper()
+
+
+def _iso_date(date):
+    """ Converts an RSS feed MM/DD/YYYY date to the sortable ISO-8601
+    YYYY-MM-DD form. Anything not in the expected form is returned as is.
+    """
+    if date is not None and len(date) == 10 and date[2] == date[5] == '/':
+        return date[6:] + '-' + date[:2] + '-' + date[3:5]
+    return date
+
+
+def _iso_datetime(datetime):
+    """ Converts an RSS feed YYYYMMDDHHMMSS datetime to the sortable ISO-8601
+    YYYY-MM-DDTHH:MM:SS form. Anything not in the expected form is returned
+    as is.
+    """
+    if datetime is not None and len(datetime) == 14 and datetime.isdigit():
+        return (datetime[:4] + '-' + datetime[4:6] + '-' + datetime[6:8] +
+                'T' + datetime[8:10] + ':' + datetime[10:12] + ':' +
+                datetime[12:])
+    return datetime
+
+
+def _parse_xbrlfiles(edgar_sub_elem, item):
 
-    ed_xbrl = './/edgar:' + 'xbrlFile'
-    xbrl_files = edgar_sub_elem.findall(ed_xbrl, namespaces=edgar_ns)
-    xml_filing_found = False
     xbrl_url = None
-    for xbrl_file in xbrl_files:
-        xbrl_type = xbrl_file.attrib['{http://www.sec.gov/Archives/edgar}type']
+    for xbrl_file in edgar_sub_elem:
+        if xbrl_file.tag != XBRL_FILE_TAG:
+            continue
+        xbrl_type = xbrl_file.attrib[XBRL_TYPE_ATTR]
         if xbrl_type == "EX-101.INS" or xbrl_type == 'EX-100.INS':
-            xbrl_url = \
-                    xbrl_file.attrib['{http://www.sec.gov/Archives/edgar}url']
-            xml_filing_found = True
+            xbrl_url = xbrl_file.attrib[XBRL_URL_ATTR]
             break
-    if xml_filing_found is False:
+    else:
         item_title = item.find('title')
-        logging.warning('No EX-101 or EX-100 xml files found for  %s',
-                        item_title.text)
+        logger.warning('No EX-101 or EX-100 xml files found for  %s',
+                       item_title.text)
 
     return xbrl_url
 
 
+EDGAR_KEYS = (
+    'company_name', 'form_type', 'filing_date', 'cik_number',
+    'accession_number', 'file_number', 'acceptance_datetime',
+    'period', 'assistant_director', 'assigned_sic', 'fiscal_year_end',
+    'xbrl_files'
+    )
+
+EDGAR_LABELS = (
+    'companyName', 'formType', 'filingDate', 'cikNumber',
+    'accessionNumber', 'fileNumber', 'acceptanceDatetime',
+    'period', 'assistantDirector', 'assignedSic', 'fiscalYearEnd',
+    'xbrlFiles'
+)
+
+
+class Filing(collections.namedtuple('Filing', EDGAR_KEYS)):
+    """ The details of a single filing, as parsed from an RSS feed
+
+    A tuple of the values of EDGAR_KEYS, in order, whose values may also be
+    read as attributes, filing.form_type say. The fields whose values
+    repeat, INTERNED_KEYS and SHARED_KEYS, hold a single copy of each value
+    shared by the filings parsed, rather than each holding a string of its
+    own.
+    """
+    __slots__ = ()
+
+
+# The fields of few distinct values, from filing to filing and feed to
+# feed, interned as they are parsed
+INTERNED_KEYS = CATEGORICAL_KEYS + ('fiscal_year_end', 'period')
+
+# The fields whose values repeat across each company's filings, or each
+# day's, shared between the filings of a feed as it is parsed. They are not
+# interned, which would keep every value ever parsed for the life of the
+# process.
+SHARED_KEYS = ('company_name', 'cik_number', 'file_number', 'filing_date')
+
+# The position of each key in the rows parsed from the feeds
+_EDGAR_COLUMNS = {key: column for column, key in enumerate(EDGAR_KEYS)}
+_INTERNED_COLUMNS = tuple(_EDGAR_COLUMNS[key] for key in INTERNED_KEYS)
+_SHARED_COLUMNS = tuple(_EDGAR_COLUMNS[key] for key in SHARED_KEYS)
+_COMPANY_NAME = _EDGAR_COLUMNS['company_name']
+_FILING_DATE = _EDGAR_COLUMNS['filing_date']
+_CIK_NUMBER = _EDGAR_COLUMNS['cik_number']
+_ACCESSION_NUMBER = _EDGAR_COLUMNS['accession_number']
+_ACCEPTANCE_DATETIME = _EDGAR_COLUMNS['acceptance_datetime']
+_XBRL_FILES = _EDGAR_COLUMNS['xbrl_files']
+
+# Maps the namespaced tag of each edgar:xbrlFiling child to its column
+_EDGAR_TAG_COLUMNS = {
+    '{' + EDGAR_NS + '}' + label: column
+    for column, label in enumerate(EDGAR_LABELS)
+}
+
+# Upserts a row, in EDGAR_KEYS order, into the feeds table
+_UPSERT_FEED_SQL = 'INSERT OR REPLACE INTO feeds ({}) VALUES ({})'.format(
+    ', '.join(EDGAR_KEYS), ', '.join('?' * len(EDGAR_KEYS)))
+
+
+def _parse_item_row(item, values=None):
+    """ Extracts the filing details from a single RSS feed <item> as a row,
+    a Filing holding the values of EDGAR_KEYS in order.
+
+    The children of the item's edgar:xbrlFiling element are walked once,
+    each tag being mapped to its column through _EDGAR_TAG_COLUMNS. Where a
+    tag is repeated the first occurrence is used, missing tags are set to
+    None. Dates are converted to ISO-8601 and the INTERNED_KEYS interned.
+
+    Args:
+        item (lxml.etree._Element): The <item> element.
+        values (dict): The values of the SHARED_KEYS already parsed from the
+            feed, keyed by themselves, which the row's are replaced by, and
+            added to, so that the rows of the feed share them.
+    """
+    row = [None] * len(EDGAR_KEYS)
+    seen = set()
+    edgar_sub_elems = item.find(XBRL_FILING_TAG)
+    if edgar_sub_elems is None:
+        edgar_sub_elems = ()
+    for edgar_sub_elem in edgar_sub_elems:
+        column = _EDGAR_TAG_COLUMNS.get(edgar_sub_elem.tag)
+        if column is None or column in seen:
+            continue
+        seen.add(column)
+        # xbrlfiles contains the URLs of the actual filings
+        if column == _XBRL_FILES:
+            row[column] = _parse_xbrlfiles(edgar_sub_elem, item)
+        else:
+            row[column] = edgar_sub_elem.text
+
+    row[_FILING_DATE] = _iso_date(row[_FILING_DATE])
+    row[_ACCEPTANCE_DATETIME] = _iso_datetime(row[_ACCEPTANCE_DATETIME])
+    for column in _INTERNED_COLUMNS:
+        if row[column] is not None:
+            row[column] = sys.intern(row[column])
+    if values is not None:
+        for column in _SHARED_COLUMNS:
+            if row[column] is not None:
+                row[column] = values.setdefault(row[column], row[column])
+    return Filing._make(row)
+
+
+def _parse_item(item):
+    """ Extracts the filing details from a single RSS feed <item> as a dict
+    keyed by EDGAR_KEYS, see _parse_item_row().
+    """
+    return dict(zip(EDGAR_KEYS, _parse_item_row(item)))
+
+
+def _iter_sec_rss_rows(rss_filename):
+    """ Yields the row, see _parse_item_row(), of each item of a feed"""
+    from lxml import etree
+
+    # The SHARED_KEYS values of the feed, freed once it has been parsed
+    values = {}
+    with storage.open_file(rss_filename) as rss_file:
+        context = etree.iterparse(rss_file, events=('end',), tag='item')
+        for _, item in context:
+            yield _parse_item_row(item, values)
+            # Free the item, and the already processed items preceding it,
+            # which would otherwise stay attached to the channel element.
+            item.clear()
+            while item.getprevious() is not None:
+                del item.getparent()[0]
+        del context
+
+
+def _iter_sec_rss_feed(rss_filename):
+    for row in _iter_sec_rss_rows(rss_filename):
+        yield dict(zip(EDGAR_KEYS, row))
+
+
+def _parse_sec_rss_rows(rss_filename):
+    """ Parses an Edgar RSS feed into a list of rows, see _parse_item_row().
+
+    A module level function, rather than a SecIndexer method, so that it
+    can be run in the worker processes used by SecIndexer.ingest_sec_feeds()
+    """
+    return list(_iter_sec_rss_rows(rss_filename))
+
+
+def _rows_to_dict(rows):
+    """ Converts rows to a dict of lists keyed by EDGAR_KEYS"""
+    if not rows:
+        return {edgar_key: [] for edgar_key in EDGAR_KEYS}
+    return dict(zip(EDGAR_KEYS, map(list, zip(*rows))))
+
+
+def _parse_sec_rss_feed(rss_filename):
+    """ Parses an Edgar RSS feed into a dict of lists keyed by EDGAR_KEYS"""
+    return _rows_to_dict(_parse_sec_rss_rows(rss_filename))
+
+
+def _timed_parse_sec_rss_rows(rss_filename):
+    """ Parses an Edgar RSS feed, as _parse_sec_rss_rows(), returning the
+    seconds taken and the rows, for the worker processes.
+    """
+    start = time.monotonic()
+    rows = _parse_sec_rss_rows(rss_filename)
+    return time.monotonic() - start, rows
+
+
+def _xbrl_urls_query(from_year, to_year, form_type='All'):
+    """ Returns the query, and its parameters, run by
+    SecIndexer._select_xbrl_urls() over the CIKs in the batch_ciks table.
+    """
+    # TODO maybe allow from month and to month
+    query = ('SELECT accession_number, xbrl_files '
+             'FROM batch_ciks '
+             'CROSS JOIN feeds USING (cik_number) WHERE '
+             'filing_date BETWEEN ? AND ? AND xbrl_files IS NOT NULL')
+    params = ['{}-01-01'.format(from_year), '{}-12-31'.format(to_year)]
+    if form_type != 'All':
+        query += ' AND form_type = ?'
+        params.append(form_type)
+    query += ' ORDER BY cik_number, filing_date'
+    return query, params
+
+
 def _month_year_iter(from_year, to_year, from_month, to_month):
     ym_from = 12 * from_year + from_month - 1
     ym_to = 12 * to_year + to_month
@@ -59,6 +307,71 @@ def _month_year_iter(from_year, to_year, from_month, to_month):
         year, month = divmod(yearm, 12)
         yield year, month + 1
 
+
+def _is_open_month(year, month):
+    """ Whether the SEC may still be adding filings to a month's feed. The
+    current month's feed is appended to as filings are made, and the
+    previous month's is treated as open too, to pick up its final filings.
+    """
+    now = time.gmtime()
+    return 12 * year + month >= 12 * now.tm_year + now.tm_mon - 1
+
+
+def _bounded_map(executor, func, iterable, window):
+    """ Like executor.map() but submits no more than window calls ahead of
+    the results consumed, bounding the memory held by unconsumed results.
+    Results are returned in the order of iterable.
+    """
+    pending = collections.deque()
+    for arg in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, arg))
+    while pending:
+        yield pending.popleft().result()
+
+
+def _prefetch(iterable, size):
+    """ Iterates over iterable on a background thread, which runs up to size
+    items ahead of those consumed and then waits for the consumer, through a
+    bounded queue. Exceptions raised by iterable are raised to the consumer.
+    """
+    items = queue.Queue(size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as err:
+            put((done, err))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, err = items.get()
+            if item is done:
+                if err is not None:
+                    raise err
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
 # TODO
 # Check on classname syntax
 # finish of classifying
@@ -66,62 +379,561 @@ def _month_year_iter(from_year, to_year, from_month, to_month):
 
 
 class SecIndexer():
-    def __init__(self, work_dir="edgar/"):
+    # Upper bound on the number of concurrent downloads, whatever the number
+    # of jobs requested.
+    max_jobs = 8
+
+    # Seconds before a cached ticker to CIK mapping is looked up again
+    cik_ttl = 30 * 24 * 60 * 60
+
+    def __init__(self, work_dir="edgar/", jobs=None,
+                 rate_limit=downloader.SEC_REQUESTS_PER_SECOND, cik_ttl=None,
+                 compression=None, base_url=SEC_BASE_URL):
         self.work_dir = work_dir
+        # Where the feeds are downloaded from and CIKs looked up, the
+        # filings are downloaded from the URLs listed in the feeds.
+        self.base_url = base_url.rstrip('/')
+        # The most downloads in flight, or None for max_jobs, within which
+        # the scheduler adapts the concurrency, see _download_jobs()
+        self.jobs = jobs
+        # How downloaded feeds and filings are stored: None, 'gzip' or 'zstd'
+        storage.check_compression(compression)
+        self.compression = compression
+        if cik_ttl is not None:
+            self.cik_ttl = cik_ttl
         self.database = os.path.join(self.work_dir, 'edgar.db')
         self.feed_dir = os.path.join(self.work_dir, 'rss-archives')
         self.filings_dir = os.path.join(self.work_dir, 'filings')
 
-        self.edgar_keys = (
-            'company_name', 'form_type', 'filing_date', 'cik_number',
-            'accession_number', 'file_number', 'acceptance_datetime',
-            'period', 'assistant_director', 'assigned_sic', 'fiscal_year_end',
-            'xbrl_files'
-            )
+        self.edgar_keys = EDGAR_KEYS
+        self.edgar_labels = EDGAR_LABELS
 
-        self.edgar_labels = (
-            'companyName', 'formType', 'filingDate', 'cikNumber',
-            'accessionNumber', 'fileNumber', 'acceptanceDatetime',
-            'period', 'assistantDirector', 'assignedSic', 'fiscalYearEnd',
-            'xbrlFiles'
-        )
+        # Timings and counters for each stage of the downloads and ingest
+        self.metrics = metrics.Metrics()
 
-        # FIXME, need to use a private logger not the root one.
-        # logging.basicConfig(filename='logging.log',level=logging.DEBUG)
-        logging.basicConfig(level=logging.INFO)
+        # Created on first use, see session
+        self._session = None
+        self._session_lock = threading.Lock()
+        # Shared by all of the downloads made through this indexer, so that
+        # together they keep within the SEC's limit on requests per second.
+        self.rate_limiter = downloader.TokenBucket(rate_limit)
+        # Retries the feed, filing and CIK requests the SEC fails or
+        # throttles, adapting their concurrency to how fast it serves them.
+        self.scheduler = downloader.RequestScheduler(self.rate_limiter,
+                                                     self.max_jobs)
 
         self._prep_directories()
         self._prep_database_table()
 
+    @property
+    def session(self):
+        """ The requests.Session the downloads are made through
+
+        A single pooled session lets the downloads reuse their keep-alive
+        connections to the SEC rather than opening one per request. It is
+        created on first use, so that commands which make no requests need
+        not import requests.
+        """
+        with self._session_lock:
+            if self._session is None:
+                import requests
+
+                self._session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_maxsize=self.max_jobs)
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+            return self._session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+
     def download_sec_feeds(self, from_year, to_year,
-                           from_month=1, to_month=12):
+                           from_month=1, to_month=12, jobs=None,
+                           refresh=False, force=False):
         """Downloads and parses Edgar RSS feeds
 
         Downloads and parses RSS feeds for the range of dates given. The
-        parsed feeds are stored in a mysqlite3 database.
+        parsed feeds are stored in a mysqlite3 database. Each month is
+        upserted into the database, in its own transaction, as soon as it
+        has been parsed; months outside of the range are left untouched.
+        Downloading, parsing and saving overlap, so that a long backfill
+        takes about as long as the slowest of them.
 
         Args:
         from_year (int): The start year to begin downloading feeds from.
         to_year (int): The end  year for which feeds are desired.
         from_month (int): The start month for feeds.
         to_month (int): The end month for feeds.
+        jobs (int): The most feeds to download concurrently, capped at
+            max_jobs. Defaults to the jobs the indexer was created with,
+            see _download_jobs().
+        refresh (bool): Whether to refresh the feeds of open months, those
+            still being added to by the SEC, which were already downloaded.
+            Only the feeds which have changed are downloaded and parsed.
+        force (bool): Whether to parse feeds which are unchanged since they
+            were last ingested, which are otherwise skipped.
 
         Dates are inclusive
 
         Returns:
         None
         """
-        dicts = []
+        months = list(_month_year_iter(from_year, to_year,
+                                       from_month, to_month))
+        jobs = max(1, min(self._download_jobs(jobs), len(months)))
+
+        # The downloads, parsing and saving of the months run as a pipeline
+        # of stages on their own threads, joined by bounded queues: the
+        # feeds after month N download, on up to `jobs` threads, as many as
+        # the scheduler's concurrency limit allows, while month N
+        # parses and month N - 1 is saved by this thread, the only one
+        # writing the feeds. A stage which gets a couple of months ahead
+        # waits for the next, so only a few parsed months are ever held in
+        # memory, however many months there are.
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            filenames = _prefetch(_bounded_map(
+                executor,
+                lambda year_month: self._download_sec_feed(
+                    year_month[0], year_month[1], refresh),
+                months, jobs), jobs)
+            changed = self._changed_feeds(filenames, force)
+            parsed = _prefetch(
+                (((feed_file, state), self.parse_sec_rss_rows(feed_file))
+                 for feed_file, state in changed), 2)
+            for (feed_file, state), rows in parsed:
+                self._save_feed(feed_file, state, rows)
+
+    def _download_jobs(self, jobs=None):
+        """ Returns the most downloads to have in flight at once
+
+        This is a cap on the concurrency, not the concurrency itself: the
+        downloads are run on this many workers, but each request waits for
+        one of the scheduler's slots, whose number it raises while the SEC
+        serves the requests and halves when it throttles them.
+
+        Args:
+            jobs (int): The cap requested, defaults to the jobs the indexer
+                was created with, or else max_jobs.
+
+        Returns:
+            jobs (int): The cap, no more than max_jobs.
+        """
+        return min(jobs or self.jobs or self.max_jobs, self.max_jobs)
+
+    def _changed_feeds(self, feed_files, force=False):
+        """ Yields the (feed_file, state) of each of the feed files which
+        has changed since it was last ingested, see _changed_feed_state(),
+        skipping those which are None.
+        """
+        for feed_file in feed_files:
+            if feed_file is None:
+                continue
+            state = self._changed_feed_state(feed_file, force)
+            if state is not None:
+                yield feed_file, state
+
+    def _changed_feed_state(self, feed_file, force=False):
+        """ Checks whether a feed file has changed since it was last ingested
+
+        The feed_state table records the size, mtime and SHA-256 of each feed
+        file ingested, keyed by the name of the feed without any compression
+        suffix. A file whose size and mtime match is unchanged; one where
+        they differ is hashed, and is unchanged if the hash matches, as when
+        a feed is downloaded again with the same content.
+
+        Returns:
+            state (tuple): The (size, mtime, sha256) of the file if it has
+            changed, or force is set, or None if it is unchanged.
+        """
+        feed = storage.logical_name(os.path.basename(feed_file))
+        stat = os.stat(feed_file)
+        conn = sqlite3.connect(self.database)
+        row = conn.execute('SELECT size, mtime, sha256 FROM feed_state '
+                           'WHERE feed = ?', (feed,)).fetchone()
+        if row is not None and not force and row[:2] == (stat.st_size,
+                                                         stat.st_mtime):
+            conn.close()
+            logger.info('Skipping unchanged RSS feed %s', feed_file)
+            return None
+
+        sha256 = hashlib.sha256()
+        with open(feed_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(storage.CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        sha256 = sha256.hexdigest()
+        if row is not None and not force and row[2] == sha256:
+            with conn:
+                conn.execute('UPDATE feed_state SET size = ?, mtime = ? '
+                             'WHERE feed = ?',
+                             (stat.st_size, stat.st_mtime, feed))
+            conn.close()
+            logger.info('Skipping unchanged RSS feed %s', feed_file)
+            return None
+        conn.close()
+        return stat.st_size, stat.st_mtime, sha256
+
+    def _save_feed(self, feed_file, state, rows):
+        """ Saves the rows parsed from a feed to the database and records the
+        state of the feed file they were parsed from in the feed_state table.
+        """
+        self._save_rows_to_database(rows)
+        size, mtime, sha256 = state
+        conn = sqlite3.connect(self.database)
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO feed_state (feed, size, '
+                         'mtime, sha256, rows, ingested) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (storage.logical_name(os.path.basename(feed_file)),
+                          size, mtime, sha256, len(rows), time.time()))
+        conn.close()
+
+    def ingest_sec_feeds(self, from_year=None, to_year=None,
+                         from_month=1, to_month=12, rss_dir=None, jobs=None,
+                         force=False):
+        """Parses previously downloaded Edgar RSS feeds into the database
 
-        for year, month in _month_year_iter(from_year, to_year,
-                                            from_month, to_month):
-            filename = self._download_sec_feed(year, month)
-            edgar_dict = self.parse_sec_rss_feeds(filename)
-            dicts.append(edgar_dict)
+        Parses the local xbrlrss-YYYY-MM.xml files found in rss_dir, which
+        may be compressed, nothing is downloaded. The feeds are parsed across
+        a pool of processes, the parsed months being upserted into the
+        database, in month order, by this process alone so that sqlite3 only
+        ever has a single writer.
 
-        self._save_dicts_to_database(dicts)
+        Feeds unchanged since they were last ingested are skipped, see
+        _changed_feed_state(), unless force is set.
 
-    def download_xbrl_data(self, cik, from_year, to_year, form_type='All'):
+        Args:
+        from_year (int): The start year of the feeds to ingest, or None for
+            the earliest feed found.
+        to_year (int): The end year of the feeds to ingest, or None for the
+            latest feed found.
+        from_month (int): The start month for feeds.
+        to_month (int): The end month for feeds.
+        rss_dir (str): The directory holding the feeds, defaults to the
+            rss-archives directory of the work_dir.
+        jobs (int): The number of parsing processes, defaults to the number
+            of CPUs.
+        force (bool): Whether to ingest feeds even if they are unchanged.
+
+        Dates are inclusive
+
+        Returns:
+        feed_files (list): The feed files which were ingested, those skipped
+        as unchanged are left out.
+        """
+        rss_dir = rss_dir or self.feed_dir
+        feed_files = []
+        for filename in sorted(os.listdir(rss_dir)):
+            match = FEED_FILENAME_RE.match(filename)
+            if match is None:
+                continue
+            year_month = (int(match.group(1)), int(match.group(2)))
+            if from_year is not None and year_month < (from_year, from_month):
+                continue
+            if to_year is not None and year_month > (to_year, to_month):
+                continue
+            feed_file = os.path.join(rss_dir, filename)
+            state = self._changed_feed_state(feed_file, force)
+            if state is not None:
+                feed_files.append((feed_file, state))
+        logger.info('Ingesting %d changed RSS feeds from %s',
+                    len(feed_files), rss_dir)
+
+        jobs = min(jobs or os.cpu_count() or 1, len(feed_files))
+        if jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                parsed = _bounded_map(
+                    executor, _timed_parse_sec_rss_rows,
+                    [feed_file for feed_file, _ in feed_files], 2 * jobs)
+                for (feed_file, state), (seconds, rows) in zip(
+                        feed_files, parsed):
+                    logger.info('Parsed RSS feed %s', feed_file)
+                    self.metrics.record('parse', seconds, len(rows),
+                                        os.path.getsize(feed_file))
+                    self._save_feed(feed_file, state, rows)
+        else:
+            for feed_file, state in feed_files:
+                rows = self.parse_sec_rss_rows(feed_file)
+                self._save_feed(feed_file, state, rows)
+
+        return [feed_file for feed_file, _ in feed_files]
+
+    def export_feeds(self, export_dir=None, full=False):
+        """ Exports the feeds table as a Parquet dataset
+
+        Writes the feeds table as Parquet files partitioned by the year and
+        month of the filing date, laid out as
+        export_dir/year=YYYY/month=MM/feeds.parquet, which
+        pandas.read_parquet() and other Arrow readers load as a single
+        partitioned dataset. The
+        low cardinality form_type, assigned_sic and assistant_director
+        columns are stored as categoricals and the dates as timestamps.
+
+        Exports are incremental: only the partitions whose rows have been
+        modified since they were last exported to export_dir, or whose file
+        is missing, are written. Each file is written to a temporary name and
+        renamed into place, so readers never see a partial partition.
+        Requires pyarrow.
+
+        Args:
+            export_dir (str): The directory to export to, defaults to the
+                parquet directory of the work_dir.
+            full (bool): Whether to write every partition, changed or not.
+
+        Returns:
+            months (list): The YYYY-MM months of the partitions written.
+        """
+        import pandas as pd
+
+        export_dir = os.path.abspath(export_dir or
+                                     os.path.join(self.work_dir, 'parquet'))
+        conn = sqlite3.connect(self.database)
+        partitions = conn.execute(
+            'SELECT partitions.month, modified, exported FROM partitions '
+            'LEFT JOIN exports ON exports.export_dir = ? AND '
+            'exports.month = partitions.month ORDER BY partitions.month',
+            (export_dir,)).fetchall()
+
+        months = []
+        for month, modified, exported in partitions:
+            year, month_of_year = month.split('-')
+            partition_file = os.path.join(
+                export_dir, 'year=' + year, 'month=' + month_of_year,
+                'feeds.parquet')
+            if not (full or exported is None or modified >= exported or
+                    not os.path.exists(partition_file)):
+                continue
+            months.append(month)
+
+            # Rows modified while the partition is being written are picked
+            # up by the next export.
+            exported = time.time()
+            df = pd.read_sql('SELECT * FROM feeds WHERE filing_date '
+                             'BETWEEN ? AND ? ORDER BY filing_date',
+                             conn, params=(month + '-01', month + '-31'))
+            for key in CATEGORICAL_KEYS:
+                df[key] = df[key].astype('category')
+            df['filing_date'] = pd.to_datetime(df['filing_date'])
+            df['acceptance_datetime'] = pd.to_datetime(
+                df['acceptance_datetime'], errors='coerce')
+
+            partition_dir = os.path.dirname(partition_file)
+            if not os.path.isdir(partition_dir):
+                os.makedirs(partition_dir)
+            df.to_parquet(partition_file + '.part', index=False)
+            os.replace(partition_file + '.part', partition_file)
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO exports (export_dir, '
+                             'month, exported, rows) VALUES (?, ?, ?, ?)',
+                             (export_dir, month, exported, len(df)))
+            logger.info('Exported %d rows to %s', len(df), partition_file)
+        conn.close()
+        return months
+
+    def compress_work_dir(self, compression=None):
+        """ Compresses the feeds and filings already stored in the work_dir
+
+        Compresses, in place, every uncompressed file in the rss-archives
+        and filings directories, and the directories of the filings within
+        it, updating the downloads table to match. Feeds already ingested
+        have their state updated to that of the compressed file, so they are
+        not parsed again.
+        Compressed feeds are read transparently by parse_sec_rss_feeds().
+
+        Args:
+            compression (str): 'gzip' or 'zstd', defaults to the compression
+                the indexer was created with, or else 'gzip'.
+
+        Returns:
+            count (int): The number of files compressed.
+        """
+        compression = compression or self.compression or 'gzip'
+        storage.check_compression(compression)
+        suffixes = tuple(storage.SUFFIXES.values())
+        count = 0
+        conn = sqlite3.connect(self.database)
+        for top in (self.feed_dir, self.filings_dir):
+            for directory, _, filenames in sorted(os.walk(top)):
+                for filename in sorted(filenames):
+                    # Leave compressed files, and the temporary files of any
+                    # downloads in progress, alone
+                    if (filename.endswith(suffixes) or
+                            filename.startswith('.')):
+                        continue
+                    filename = os.path.join(directory, filename)
+                    ingested = (top == self.feed_dir and
+                                self._changed_feed_state(filename) is None)
+                    compressed, size, sha256 = storage.compress_file(
+                        filename, compression)
+                    with conn:
+                        conn.execute('UPDATE downloads SET local_path = ?, '
+                                     'size = ?, sha256 = ? '
+                                     'WHERE local_path = ?',
+                                     (compressed, size, sha256, filename))
+                        if ingested:
+                            conn.execute('UPDATE feed_state SET size = ?, '
+                                         'mtime = ?, sha256 = ? '
+                                         'WHERE feed = ?',
+                                         (size, os.stat(compressed).st_mtime,
+                                          sha256,
+                                          os.path.basename(filename)))
+                    count += 1
+        conn.close()
+        logger.info('Compressed %d files in %s', count, self.work_dir)
+        return count
+
+    def get_cik(self, ticker):
+        """ Returns the CIK corresponding to a ticker
+
+        The CIK is taken from the ciks table of the database when it was
+        cached there less than cik_ttl seconds ago, otherwise it is looked
+        up on the edgar site, with get_cik(), and cached.
+
+        Args:
+            ticker (str): The ticker symbol, in any case.
+
+        Returns:
+            cik (str): The zero padded ten digit CIK.
+
+        Raises:
+            ValueError: If the CIK of the ticker could not be looked up.
+        """
+        ciks = self.get_ciks([ticker])
+        if _format_ticker(ticker) not in ciks:
+            raise ValueError('Could not look up the CIK of ticker {}'
+                             .format(ticker))
+        return ciks[_format_ticker(ticker)]
+
+    def get_ciks(self, tickers):
+        """ Returns the CIKs corresponding to a list of tickers
+
+        Resolves all of the tickers cached in the ciks table with a few
+        local queries, only those missing or expired are looked up on the
+        edgar site. Each CIK looked up is cached as soon as it is found, and
+        a ticker which cannot be looked up, being unknown to edgar or its
+        request failing, is logged and left out rather than failing the
+        rest of the tickers.
+
+        Args:
+            tickers (iterable): The ticker symbols, in any case.
+
+        Returns:
+            ciks (Dict): The CIK of each ticker found, keyed by the upper
+            case ticker.
+        """
+        tickers = sorted(set(_format_ticker(t) for t in tickers))
+        expires = time.time() - self.cik_ttl
+        ciks = {}
+        conn = sqlite3.connect(self.database)
+        try:
+            # Keep below sqlite3's limit on the number of query parameters
+            for start in range(0, len(tickers), 500):
+                chunk = tickers[start:start + 500]
+                query = ('SELECT ticker, cik_number FROM ciks WHERE '
+                         'updated > ? AND ticker IN ({})'
+                         .format(','.join('?' * len(chunk))))
+                ciks.update(conn.execute(query, [expires] + chunk))
+
+            missing = [ticker for ticker in tickers if ticker not in ciks]
+            if missing:
+                import requests
+            for ticker in missing:
+                logger.info('Looking up the CIK of %s on edgar', ticker)
+                try:
+                    with self.metrics.timer('cik_lookup') as sample:
+                        cik = self.scheduler.run(get_cik, ticker,
+                                                 self.base_url, self.session)
+                        sample.items = 1
+                except (ValueError,
+                        requests.exceptions.RequestException) as err:
+                    logger.warning('Skipping ticker %s: %s', ticker, err)
+                    continue
+                ciks[ticker] = cik
+                with conn:
+                    conn.execute('INSERT OR REPLACE INTO ciks (ticker, '
+                                 'cik_number, updated) VALUES (?, ?, ?)',
+                                 (ticker, cik, time.time()))
+        finally:
+            conn.close()
+        return ciks
+
+    def search_companies(self, query, limit=10):
+        """ Searches the names of the companies in the feeds table
+
+        Each word of the query matches the start of a word of the company
+        name, in any case, so that "app inc" finds "APPLE INC". Matches are
+        looked up in the company_names full text index and ranked by
+        relevance, or found by scanning the companies table when the sqlite3
+        library lacks FTS5.
+
+        Args:
+            query (str): The words to search for.
+            limit (int): The largest number of companies to return.
+
+        Returns:
+            companies (list): (cik_number, company_name) tuples, best match
+            first. A company which has filed under several names, or a name
+            shared by several CIKs, is listed once for each.
+        """
+        words = re.findall(r'\w+', query)
+        if not words:
+            return []
+        conn = sqlite3.connect(self.database)
+        indexed = conn.execute("SELECT 1 FROM sqlite_master WHERE "
+                               "name = 'company_names'").fetchone()
+        if indexed:
+            match = ' '.join('"{}"*'.format(word) for word in words)
+            rows = conn.execute(
+                'SELECT companies.cik_number, companies.company_name '
+                'FROM company_names JOIN companies '
+                'ON companies.rowid = company_names.rowid '
+                'WHERE company_names MATCH ? ORDER BY rank LIMIT ?',
+                (match, limit)).fetchall()
+        else:
+            where = ' AND '.join(['company_name LIKE ?'] * len(words))
+            rows = conn.execute(
+                'SELECT cik_number, company_name FROM companies WHERE {} '
+                'ORDER BY length(company_name) LIMIT ?'.format(where),
+                ['%{}%'.format(word) for word in words] + [limit]).fetchall()
+        conn.close()
+        return rows
+
+    def load_company_tickers(self, tickers_file):
+        """ Bulk loads ticker to CIK mappings into the ciks table
+
+        Loads the company_tickers.json file published by the SEC at
+        https://www.sec.gov/files/company_tickers.json, whose entries have
+        cik_str, ticker and title keys.
+
+        Args:
+            tickers_file (str): A local copy of company_tickers.json
+
+        Returns:
+            count (int): The number of tickers loaded.
+        """
+        with open(tickers_file) as f:
+            companies = json.load(f)
+        if isinstance(companies, dict):
+            companies = companies.values()
+        now = time.time()
+        rows = [(_format_ticker(company['ticker']),
+                 _format_cik(company['cik_str']), company.get('title'), now)
+                for company in companies]
+
+        conn = sqlite3.connect(self.database)
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO ciks (ticker, '
+                             'cik_number, company_name, updated) '
+                             'VALUES (?, ?, ?, ?)', rows)
+        conn.close()
+        logger.info('Loaded %d tickers from %s', len(rows), tickers_file)
+        return len(rows)
+
+    def download_xbrl_data(self, cik, from_year, to_year, form_type='All',
+                           jobs=None):
         """Downloads xbrl filing data from the SEC edgar website
 
         Requires that the user has previously downloaded and indexed the feeds
@@ -131,98 +943,243 @@ class SecIndexer():
         to "./edgar" within the directory the application is running in.
 
         Args:
-            cik (str): The SEC CIK number associatd with the filer.
+            cik (str or int): The SEC CIK number associatd with the filer.
             from_year (int): Beginning year to download filings from.
             to_year (int): Ending year for forms download.
             form_type (str: "10-K", "10-Q" or "All" (defaults to "All")
+            jobs (int): The most filings to download concurrently, capped
+                at max_jobs. Defaults to the jobs the indexer was created
+                with, see _download_jobs().
+
+        Returns:
+            results (list): A downloader.DownloadResult for each filing
+            downloaded.
 
         """
-        logging.debug('download_xbrl_data: cik = %s, form_type = %s,'
-                      'from_year = %d, to_year = %d', cik, form_type,
-                      from_year, to_year)
+        logger.debug('download_xbrl_data: cik = %s, form_type = %s,'
+                     'from_year = %d, to_year = %d', cik, form_type,
+                     from_year, to_year)
 
-        conn = sqlite3.connect(self.database)
-        df = pd.read_sql('SELECT * from feeds', conn)
-        df.head()
+        return self.download_xbrl_batch([cik], from_year, to_year,
+                                        form_type, jobs)
 
-        df['filing_date'] = pd.to_datetime(
-                                df['filing_date'],
-                                format='%m/%d/%Y')
+    def download_xbrl_batch(self, ciks, from_year, to_year, form_type='All',
+                            jobs=None):
+        """Downloads the xbrl filings of many filers from the SEC edgar website
 
-        # TODO maybe allow from month and to month
-        from_date = str(from_year) + '-01-01'
-        to_date = str(to_year) + '-12-31'
+        Batch version of download_xbrl_data(). The filings of all of the
+        filers are selected by a single query, the URLs are deduplicated and
+        all of the filings are then handed to one download scheduler.
 
-        if form_type == 'All':
-            mask = (df['filing_date'] >= from_date) \
-                   & (df['filing_date'] <= to_date) \
-                   & (df['cik_number'] == cik)
+        Each filing is saved in a directory of the filings directory named
+        by its accession number, as the instance documents of different
+        filings, an original and its amendment say, may share a file name.
 
-        else:
-            mask = (df['filing_date'] >= from_date) \
-                   & (df['filing_date'] <= to_date) \
-                   & (df['cik_number'] == cik) \
-                   & (df['form_type'] == form_type)
+        Every download is recorded in the downloads table. Filings recorded
+        there as completed, whose files are still present, are not
+        downloaded again; failed and missing ones are.
+
+        Args:
+            ciks (iterable): The SEC CIK numbers of the filers, as str or int.
+            from_year (int): Beginning year to download filings from.
+            to_year (int): Ending year for forms download.
+            form_type (str: "10-K", "10-Q" or "All" (defaults to "All")
+            jobs (int): The most filings to download concurrently, capped
+                at max_jobs. Defaults to the jobs the indexer was created
+                with, see _download_jobs().
+
+        Returns:
+            results (list): A downloader.DownloadResult for each filing
+            downloaded.
+
+        """
+        filings = self._select_xbrl_urls(ciks, from_year, to_year, form_type)
+        logger.debug('download_xbrl_batch: found %d filings', len(filings))
+
+        completed = self._completed_downloads(url for _, url in filings)
+        downloads = []
+        for accession_number, url in filings:
+            if url in completed:
+                continue
+            filing_dir = os.path.join(self.filings_dir,
+                                      accession_number or '')
+            os.makedirs(filing_dir, exist_ok=True)
+            filename = os.path.join(filing_dir, os.path.basename(url))
+            downloads.append((url, storage.stored_name(filename,
+                                                       self.compression)))
+        if completed:
+            logger.info('Skipping %d filings already downloaded',
+                        len(completed))
+
+        results = downloader.download_files(self.session, downloads,
+                                            self._download_jobs(jobs),
+                                            compression=self.compression,
+                                            scheduler=self.scheduler,
+                                            metrics=self.metrics)
+        self._record_downloads(results, dict((url, accession_number)
+                                             for accession_number, url
+                                             in filings))
+        return results
+
+    def _completed_downloads(self, urls):
+        """ Returns the set of the URLs given which the downloads table
+        records as completed, and whose files are still present and of the
+        recorded size.
+        """
+        urls = list(urls)
+        completed = set()
+        conn = sqlite3.connect(self.database)
+        # Keep below sqlite3's limit on the number of query parameters
+        for start in range(0, len(urls), 500):
+            chunk = urls[start:start + 500]
+            query = ("SELECT url, local_path, size FROM downloads WHERE "
+                     "status = 'complete' AND url IN ({})"
+                     .format(','.join('?' * len(chunk))))
+            for url, local_path, size in conn.execute(query, chunk):
+                if (os.path.exists(local_path) and
+                        os.path.getsize(local_path) == size):
+                    completed.add(url)
+        conn.close()
+        return completed
+
+    def _record_downloads(self, results, accession_numbers=None):
+        """ Records the outcome of downloads in the downloads table
+
+        Args:
+            results (list): The downloader.DownloadResult of each download.
+            accession_numbers (Dict): The accession number of the filing
+                each URL belongs to, if any.
+        """
+        accession_numbers = accession_numbers or {}
+        now = time.time()
+        rows = [(result.url, accession_numbers.get(result.url),
+                 result.filename, result.size, result.sha256, result.etag,
+                 result.last_modified,
+                 'failed' if result.error else 'complete', now)
+                for result in results]
+        conn = sqlite3.connect(self.database)
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO downloads (url, '
+                             'accession_number, local_path, size, sha256, '
+                             'etag, last_modified, status, updated) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        conn.close()
+
+    def _select_xbrl_urls(self, ciks, from_year, to_year, form_type='All'):
+        """ Selects the URLs of the filers' xbrl filings from the feeds table.
 
-        masked_df = df.loc[mask]
+        The CIKs are loaded into a temporary table which is joined with the
+        feeds table, so that one indexed, parameterized, query selects the
+        filings of every filer and only the matching rows are read from the
+        database. Each instance document URL is returned once, with the
+        first filing listing it, filings without an xbrl instance document
+        are left out.
 
-        for url in masked_df['xbrl_files']:
-            print('Downloading file {}'.format(url))
-            filename = os.path.join(self.filings_dir, os.path.basename(url))
-            print('To {}'.format(filename))
-            response = requests.get(url)
-            with open(filename, 'w') as f:
-                f.write(response.text)
+        The CROSS JOIN keeps batch_ciks as the outer loop, without it the
+        planner, which has no statistics for the temporary table, may scan
+        every filing in the date range instead.
 
-                logging.debug('download_xbrl_data: found %d filings wrote to\
-                        %s', len(masked_df), filename)
+        Returns:
+            filings (list): (accession_number, url) pairs.
+        """
+        query, params = _xbrl_urls_query(from_year, to_year, form_type)
+        conn = sqlite3.connect(self.database)
+        conn.execute('CREATE TEMP TABLE batch_ciks (cik_number PRIMARY KEY)')
+        conn.executemany('INSERT OR IGNORE INTO batch_ciks VALUES (?)',
+                         [(_format_cik(cik),) for cik in ciks])
+        # Each filing is listed once, accession_number being the key of the
+        # feeds table, but its instance document may be listed by others
+        urls = set()
+        filings = []
+        for accession_number, url in conn.execute(query, params):
+            if url not in urls:
+                urls.add(url)
+                filings.append((accession_number, url))
+        conn.close()
+        return filings
 
-    def _download_sec_feed(self, year, month):
+    def _download_sec_feed(self, year, month, refresh=False):
         """Download an SEC RSS feed for a specifc month of a given year
 
         Downloads RSS feeds from the SEC edgar website for a given year and
         month.  The feeds are stored by year and month, each containing
         details of all of the filings made to the SEC for that month
 
+        A feed already downloaded is not downloaded again, unless refresh is
+        set and the month is still open, see _is_open_month(). The refresh is
+        a conditional GET, using the HTTP validators recorded in the
+        downloads table, so an unchanged feed costs a header exchange.
+
         Args:
             year (int); The year of the feed
             month (int); The month of the feed
+            refresh (bool); Whether to refresh the feed of an open month
 
         Returns:
-            feed_file (str): The location of the downloaded RSS file.
+            feed_file (str): The location of the downloaded RSS file, that
+            of the stored file if a refreshed feed has not changed, or None
+            if the download failed.
 
         """
-        logging.debug('download_sec_feed: year = %d, month = %d', year, month)
+        logger.debug('download_sec_feed: year = %d, month = %d', year, month)
 
         feed_filename = ('xbrlrss-' + str(year) +
                          '-' + '{:02}'.format(month) + '.xml')
-        logging.debug('feed_filename = %s', feed_filename)
+        logger.debug('feed_filename = %s', feed_filename)
 
         feed_file = os.path.join(self.feed_dir, feed_filename)
-
-        if not os.path.exists(feed_file):
-            edgar_filings_feed = ('http://www.sec.gov/Archives/edgar/monthly/'
-                                  + feed_filename)
-            logging.debug('Edgar Filings Feed = %s', edgar_filings_feed)
-
-            response = None
-            try:
-                response = requests.get(edgar_filings_feed, timeout=4)
-                response.raise_for_status()
-            except requests.exceptions.RequestException as err:
-                logging.exception("RequestException:%s", err)
-                #os.sys.exit(1)
-
-            with open(feed_file, 'w') as file:
-                file.write(response.text)
-
-            logging.info('Downloaded RSS feed: %s', feed_file)
-
-        else:
-            logging.debug('Skipping download:'
-                          'RSS feed %s already downloaded', feed_file)
-
-        return feed_file
+        edgar_filings_feed = (self.base_url + '/Archives/edgar/monthly/'
+                              + feed_filename)
+
+        etag = last_modified = None
+        found_file = storage.find_file(feed_file)
+        if found_file is not None:
+            if not (refresh and _is_open_month(year, month)):
+                logger.debug('Skipping download:'
+                             'RSS feed %s already downloaded', found_file)
+                return found_file
+            etag, last_modified = self._download_validators(
+                edgar_filings_feed)
+
+        logger.debug('Edgar Filings Feed = %s', edgar_filings_feed)
+        stored_file = storage.stored_name(feed_file, self.compression)
+        import requests
+        try:
+            with self.metrics.timer('feed_download') as sample:
+                result = self.scheduler.run(
+                    downloader.fetch_file, self.session, edgar_filings_feed,
+                    stored_file, etag, last_modified, timeout=4,
+                    compression=self.compression)
+                if result is not None:
+                    sample.items, sample.bytes = 1, result.size
+        except (requests.exceptions.RequestException, OSError) as err:
+            logger.exception("RequestException:%s", err)
+            return None
+
+        if result is None:
+            # The stored feed is current, whether or not it has been ingested
+            # is for _changed_feeds() to decide
+            logger.info('RSS feed %s has not changed', found_file)
+            return found_file
+
+        # A refreshed feed replaces any copy stored with another compression
+        for variant in storage.stored_variants(feed_file):
+            if variant != stored_file:
+                os.remove(variant)
+        self._record_downloads([result])
+        logger.info('Downloaded RSS feed: %s', stored_file)
+        return stored_file
+
+    def _download_validators(self, url):
+        """ Returns the (etag, last_modified) HTTP validators recorded in the
+        downloads table for the last complete download of url.
+        """
+        conn = sqlite3.connect(self.database)
+        row = conn.execute("SELECT etag, last_modified FROM downloads WHERE "
+                           "url = ? AND status = 'complete'",
+                           (url,)).fetchone()
+        conn.close()
+        return row or (None, None)
 
     def parse_sec_rss_feeds(self, rss_filename):
         """ Parses an Edgar RSS feed into a dict
@@ -235,7 +1192,8 @@ class SecIndexer():
         The xbrl filing for each filer is NOT downloaded.
 
         Args:
-        rss_filename (str): A local copy of the RSS feed file.
+        rss_filename (str): A local copy of the RSS feed file, which may be
+            stored compressed, see the storage module.
 
         Returns:
         edgar_dict (Dict): A dictionary containing the details as filed
@@ -243,44 +1201,64 @@ class SecIndexer():
         class variable edgar_keys.
 
         """
-        logging.info("Parsing RSS feed %s", rss_filename)
+        return _rows_to_dict(self.parse_sec_rss_rows(rss_filename))
 
-        root = etree.parse(rss_filename).getroot()
-        # 'items' elements contain the filing details for each company listed
-        items = list(root.iter('item'))
-        logging.debug('%d items found in RSS feed', len(items))
+    def parse_sec_rss_rows(self, rss_filename):
+        """ Parses an Edgar RSS feed into a list of rows
 
-        edgar_dict = {edgar_key: [] for edgar_key in self.edgar_keys}
-        edgar_ns = {'edgar': 'http://www.sec.gov/Archives/edgar'}
-        for item in items:
-            for key, label in zip(self.edgar_keys, self.edgar_labels):
-                edgar_sub_elem = item.find('.//edgar:' +
-                                           label, namespaces=edgar_ns)
-                if edgar_sub_elem is None:
-                    edgar_dict[key].append(None)
-                    continue
-                # logging.debug('tag = %s',edgar_sub_elem.tag)
-                # xbrlfiles contains the URLs of the actual filings
-                if 'xbrlFiles' in edgar_sub_elem.tag:
-                    assert label == 'xbrlFiles'
-                    xbrl_url = _parse_xbrlfiles(edgar_sub_elem, edgar_ns, item)
-                    edgar_dict[key].append(xbrl_url)
-                else:
-                 #  logging.debug('text =  %s',edgar_sub_elem.text)
-                    edgar_dict[key].append(edgar_sub_elem.text)
-
-        return edgar_dict
+        Record oriented equivalent of parse_sec_rss_feeds(), and the form in
+        which the feeds are saved to the database. Each row is a Filing, a
+        namedtuple sharing the values of its repeated fields with the other
+        filings, so that parsed feeds may be held in memory as records at
+        about half the size of the dict of lists of strings of their own
+        which parse_sec_rss_feeds() used to return, see
+        benchmarks/bench_records.py.
+
+        Args:
+        rss_filename (str): A local copy of the RSS feed file.
+
+        Returns:
+        rows (list): A Filing for each filing, a tuple of its details in
+        the order of edgar_keys which may also be read as attributes.
+
+        """
+        logger.info("Parsing RSS feed %s", rss_filename)
+
+        with self.metrics.timer('parse') as sample:
+            rows = _parse_sec_rss_rows(rss_filename)
+            sample.items = len(rows)
+            sample.bytes = os.path.getsize(rss_filename)
+
+        logger.debug('%d items found in RSS feed', sample.items)
+        return rows
+
+    def iter_sec_rss_feed(self, rss_filename):
+        """ Iterates over the filings in an Edgar RSS feed
+
+        Streaming equivalent of parse_sec_rss_feeds(). The feed is parsed
+        incrementally with lxml's iterparse and each <item> element is
+        freed once its details have been extracted, so memory use is bounded
+        by the size of a single item rather than by the size of the feed.
+
+        Args:
+        rss_filename (str): A local copy of the RSS feed file.
+
+        Yields:
+        record (Dict): The details of a single filing, keyed by edgar_keys.
+
+        """
+        return _iter_sec_rss_feed(rss_filename)
 
     def _prep_directories(self):
         """ Creates the FEEDS and the FILINGS directories"""
 
         if not os.path.isdir(self.feed_dir):
             os.makedirs(self.feed_dir)
-            logging.debug('Created new directory %s', self.feed_dir)
+            logger.debug('Created new directory %s', self.feed_dir)
 
         if not os.path.isdir(self.filings_dir):
             os.makedirs(self.filings_dir)
-            logging.debug('Created new directory %s', self.filings_dir)
+            logger.debug('Created new directory %s', self.filings_dir)
 
     def _prep_database_table(self):
         """
@@ -292,6 +1270,29 @@ class SecIndexer():
         with a PRIMARY KEY; without ths, repeated updates from subequent runs
         on the same feed would cause the database to get duplicate entries and
         grow!
+
+        Databases written by earlier versions, which replaced the whole table
+        and so lost the PRIMARY KEY, are rebuilt with the duplicates removed.
+
+        Indexes are created on the columns used to select filings. A "ciks"
+        table caches the CIK of each ticker looked up, a "downloads" table
+        records the outcome of each file downloaded, a "feed_state" table
+        the state of each feed file when it was ingested and an "exports"
+        table each partition written by export_feeds().
+
+        The database's user_version records the SCHEMA_VERSION it has been
+        migrated to. Version 1 stores dates in ISO-8601 form, older databases
+        have their MM/DD/YYYY filing dates and YYYYMMDDHHMMSS acceptance
+        datetimes converted in place, once. Version 2 adds a "partitions"
+        table recording when the rows of each filing month were last
+        modified, for export_feeds(). Version 3 adds a "companies" table of
+        the distinct CIKs and company names filed under, indexed for
+        search_companies() by the "company_names" FTS5 table when the
+        sqlite3 library supports it. Version 4 replaces the cik_number index
+        with one on (cik_number, form_type, filing_date), which serves the
+        selection of a filer's filings with or without a form type.
+        Version 5 keys the feed_state table by the name of each feed without
+        any compression suffix, so a feed keeps its state when compressed.
         """
 
         columns = ','.join(self.edgar_keys)
@@ -302,34 +1303,186 @@ class SecIndexer():
                        .format(columns))
         conn = sqlite3.connect(self.database)
         curr = conn.cursor()
+        curr.execute('PRAGMA table_info(feeds)')
+        table_info = curr.fetchall()
+        if table_info and not any(row[5] for row in table_info):
+            logger.info('Adding PRIMARY KEY to feeds table in %s',
+                        self.database)
+            curr.execute('ALTER TABLE feeds RENAME TO feeds_old')
+            curr.execute(table_parms)
+            curr.execute('INSERT OR IGNORE INTO feeds ({0}) '
+                         'SELECT {0} FROM feeds_old'
+                         .format(','.join(self.edgar_keys)))
+            curr.execute('DROP TABLE feeds_old')
         curr.execute(table_parms)
+
+        version = curr.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            logger.info('Converting feeds dates to ISO-8601 in %s',
+                        self.database)
+            curr.execute("UPDATE feeds SET filing_date = "
+                         "substr(filing_date, 7, 4) || '-' || "
+                         "substr(filing_date, 1, 2) || '-' || "
+                         "substr(filing_date, 4, 2) "
+                         "WHERE filing_date LIKE '__/__/____'")
+            curr.execute("UPDATE feeds SET acceptance_datetime = "
+                         "substr(acceptance_datetime, 1, 4) || '-' || "
+                         "substr(acceptance_datetime, 5, 2) || '-' || "
+                         "substr(acceptance_datetime, 7, 2) || 'T' || "
+                         "substr(acceptance_datetime, 9, 2) || ':' || "
+                         "substr(acceptance_datetime, 11, 2) || ':' || "
+                         "substr(acceptance_datetime, 13, 2) "
+                         "WHERE length(acceptance_datetime) = 14 AND "
+                         "acceptance_datetime NOT GLOB '*[^0-9]*'")
+            curr.execute('DROP INDEX IF EXISTS feeds_filing_year')
+
+        # The time the rows filed in each month were last modified
+        curr.execute('CREATE TABLE IF NOT EXISTS partitions (month PRIMARY '
+                     'KEY, modified)')
+        if version < 2:
+            curr.execute('INSERT OR REPLACE INTO partitions '
+                         'SELECT DISTINCT substr(filing_date, 1, 7), ? '
+                         'FROM feeds WHERE filing_date IS NOT NULL',
+                         (time.time(),))
+
+        curr.execute('CREATE TABLE IF NOT EXISTS companies (cik_number, '
+                     'company_name, PRIMARY KEY (cik_number, company_name))')
+        if version < 3:
+            curr.execute('INSERT OR IGNORE INTO companies SELECT DISTINCT '
+                         'cik_number, company_name FROM feeds '
+                         'WHERE company_name IS NOT NULL')
+        self._prep_company_names(curr)
+        if version < 4:
+            # Superseded by feeds_cik_form_date, of which it is a prefix
+            curr.execute('DROP INDEX IF EXISTS feeds_cik_number')
+
+        curr.execute('CREATE TABLE IF NOT EXISTS feed_state (feed PRIMARY '
+                     'KEY, size, mtime, sha256, rows, ingested)')
+        if version < 5:
+            for suffix in storage.SUFFIXES.values():
+                curr.execute('UPDATE OR REPLACE feed_state '
+                             'SET feed = substr(feed, 1, length(feed) - ?) '
+                             "WHERE feed LIKE '%' || ?",
+                             (len(suffix), suffix))
+        curr.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+
+        # Without statistics sqlite3 would otherwise pick feeds_form_type
+        # for a form type selection, reading every filing of the form type
+        # for each CIK
+        curr.execute('CREATE INDEX IF NOT EXISTS feeds_cik_form_date '
+                     'ON feeds (cik_number, form_type, filing_date)')
+        curr.execute('CREATE INDEX IF NOT EXISTS feeds_form_type '
+                     'ON feeds (form_type)')
+        curr.execute('CREATE INDEX IF NOT EXISTS feeds_filing_date '
+                     'ON feeds (filing_date)')
+
+        curr.execute('CREATE TABLE IF NOT EXISTS ciks (ticker PRIMARY KEY, '
+                     'cik_number, company_name, updated)')
+
+        curr.execute('CREATE TABLE IF NOT EXISTS downloads (url PRIMARY KEY, '
+                     'accession_number, local_path, size, sha256, etag, '
+                     'last_modified, status, updated)')
+
+        curr.execute('CREATE TABLE IF NOT EXISTS exports (export_dir, month, '
+                     'exported, rows, PRIMARY KEY (export_dir, month))')
         conn.commit()
         conn.close()
 
+    def _prep_company_names(self, curr):
+        """ Creates the company_names full text index of the companies table
+
+        The index is an FTS5 external content table, kept in step with the
+        companies table by triggers, and rebuilt from it when first created.
+        Without FTS5 support in the sqlite3 library there is no index and
+        search_companies() falls back to scanning the companies table.
+        """
+        exists = curr.execute("SELECT 1 FROM sqlite_master WHERE "
+                              "name = 'company_names'").fetchone()
+        if exists:
+            return
+        try:
+            curr.execute("CREATE VIRTUAL TABLE company_names USING "
+                         "fts5(company_name, content='companies')")
+        except sqlite3.OperationalError as err:
+            logger.warning('Company search is not indexed: %s', err)
+            return
+        curr.execute("CREATE TRIGGER IF NOT EXISTS companies_insert AFTER "
+                     "INSERT ON companies BEGIN INSERT INTO company_names "
+                     "(rowid, company_name) VALUES "
+                     "(new.rowid, new.company_name); END")
+        curr.execute("CREATE TRIGGER IF NOT EXISTS companies_delete AFTER "
+                     "DELETE ON companies BEGIN INSERT INTO company_names "
+                     "(company_names, rowid, company_name) VALUES "
+                     "('delete', old.rowid, old.company_name); END")
+        curr.execute("INSERT INTO company_names (company_names) "
+                     "VALUES ('rebuild')")
+
     def _save_dicts_to_database(self, dicts):
         """
-        Takes a list of dictionaries, converts to a pandas dataframe then
-        stores this into a sqlite3 database
+        Takes a list of dictionaries and upserts each one into the sqlite3
+        database, committing after each.
         """
-        d_frames = []
         for dic in dicts:
-            df = pd.DataFrame(dic)
-            d_frames.append(df)
+            self._save_dict_to_database(dic)
 
-        db_df = pd.concat(d_frames)
+    def _save_dict_to_database(self, edgar_dict):
+        """
+        Takes a dictionary, as returned by parse_sec_rss_feeds(), and upserts
+        its rows into the sqlite3 database, see _save_rows_to_database().
+        """
+        self._save_rows_to_database(
+            zip(*(edgar_dict[key] for key in self.edgar_keys)))
 
-        # deduplicate
-        len_before = len(db_df)
-        db_df.drop_duplicates('accession_number', inplace=True)
-        len_after = len(db_df)
-        dropped = len_before - len_after
-        if dropped:
-            logging.info('Dropped %d duplicates', dropped)
+    def _save_rows_to_database(self, rows):
+        """
+        Upserts rows, as returned by parse_sec_rss_rows(), into the feeds
+        table of the sqlite3 database.
+
+        Rows already in the database with the same accession_number are
+        replaced, all other rows are kept. Of the rows given with the same
+        accession_number only the first is saved. The rows are streamed into
+        a single prepared INSERT, run by executemany(), and committed as a
+        single transaction along with the partitions and companies they
+        add, so they are never copied into any other form on the way.
+
+        Args:
+        rows (iterable): The rows to save, which may be a generator.
+
+        Returns:
+        count (int): The number of rows saved.
+        """
+        accession_numbers = set()
+        months = set()
+        companies = set()
+
+        def unique_rows():
+            for row in rows:
+                accession_number = row[_ACCESSION_NUMBER]
+                if accession_number in accession_numbers:
+                    continue
+                accession_numbers.add(accession_number)
+                # Mark the months filed in as modified, for export_feeds()
+                if row[_FILING_DATE]:
+                    months.add(row[_FILING_DATE][:7])
+                if row[_COMPANY_NAME]:
+                    companies.add((row[_CIK_NUMBER], row[_COMPANY_NAME]))
+                yield row
 
-        db_df.set_index('accession_number', inplace=True)
         conn = sqlite3.connect(self.database)
     #   conn.set_trace_callback(print)
 
-        db_df.to_sql("feeds", conn, if_exists="replace", chunksize=1000)
-        logging.info('%d items parsed', len(db_df))
-        logging.info('Saved feed details to %s\n', self.database)
+        with self.metrics.timer('save') as sample:
+            with conn:
+                count = conn.executemany(_UPSERT_FEED_SQL,
+                                         unique_rows()).rowcount
+                conn.executemany('INSERT OR REPLACE INTO partitions (month, '
+                                 'modified) VALUES (?, ?)',
+                                 [(month, time.time()) for month in months])
+                conn.executemany('INSERT OR IGNORE INTO companies '
+                                 '(cik_number, company_name) VALUES (?, ?)',
+                                 companies)
+            sample.items = count
+        conn.close()
+        logger.info('%d items parsed', count)
+        logger.info('Saved feed details to %s\n', self.database)
+        return count
@@ -0,0 +1,166 @@
+"""This module provides the timings and counters kept for each stage of the
+download and ingest pipeline, so that a slow run can be traced to the
+network, the parsing of the feeds, their conversion or the database writes.
+
+:copyright: (c) 2017 by Robert Rennison
+:license: Apache 2, see LICENCE for more details
+"""
+
+import bisect
+import contextlib
+import json
+import threading
+import time
+
+from sec_edgar_download import storage
+
+# The upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+# The prefix of the Prometheus metric names
+PROMETHEUS_PREFIX = 'sec_edgar_download_stage'
+
+
+class _Stage():
+    """ The counters of a single stage"""
+    def __init__(self, buckets):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.items = 0
+        self.bytes = 0
+        self.first_start = None
+        self.last_end = None
+        self.buckets = [0] * (len(buckets) + 1)
+
+
+class _Sample():
+    """ The items and bytes handled by one timed run of a stage"""
+    def __init__(self):
+        self.items = 0
+        self.bytes = 0
+
+
+class Metrics():
+    """Per stage timings and counters, safe to share between threads.
+
+    Each run of a stage, such as the download of a feed or the parsing of
+    one, is recorded with how long it took and the number of items and bytes
+    it handled. A stage's runs may overlap, as concurrent downloads do, so
+    its throughput is given both per second of its runs, and per second of
+    the wall clock time from the start of its first run to the end of its
+    last.
+
+    Args:
+        buckets (tuple): The upper bounds of the latency histogram buckets.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, items=0, nbytes=0, error=False):
+        """ Records one run of a stage, which ended now"""
+        end = time.monotonic()
+        with self._lock:
+            counters = self.stages.get(stage)
+            if counters is None:
+                counters = self.stages[stage] = _Stage(self.buckets)
+            counters.count += 1
+            counters.errors += bool(error)
+            counters.seconds += seconds
+            counters.max_seconds = max(counters.max_seconds, seconds)
+            counters.items += items
+            counters.bytes += nbytes
+            start = end - seconds
+            if counters.first_start is None or start < counters.first_start:
+                counters.first_start = start
+            counters.last_end = end
+            counters.buckets[bisect.bisect_left(self.buckets, seconds)] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """ Times a run of a stage, the block sets the items and bytes of the
+        sample yielded. A run ended by an exception is recorded as an error.
+        """
+        sample = _Sample()
+        start = time.monotonic()
+        try:
+            yield sample
+        except BaseException:
+            self.record(stage, time.monotonic() - start, sample.items,
+                        sample.bytes, error=True)
+            raise
+        self.record(stage, time.monotonic() - start, sample.items,
+                    sample.bytes)
+
+    def summary(self):
+        """ Returns the counters of each stage, and the rates derived from
+        them, as a dict keyed by stage.
+        """
+        summary = {}
+        with self._lock:
+            for stage, counters in sorted(self.stages.items()):
+                wall = counters.last_end - counters.first_start
+                cumulative = 0
+                histogram = {}
+                for bound, count in zip(self.buckets + ('+Inf',),
+                                        counters.buckets):
+                    cumulative += count
+                    histogram[str(bound)] = cumulative
+                summary[stage] = {
+                    'count': counters.count,
+                    'errors': counters.errors,
+                    'seconds': counters.seconds,
+                    'max_seconds': counters.max_seconds,
+                    'wall_seconds': wall,
+                    'items': counters.items,
+                    'bytes': counters.bytes,
+                    'items_per_sec': _rate(counters.items, counters.seconds),
+                    'bytes_per_sec': _rate(counters.bytes, counters.seconds),
+                    'wall_items_per_sec': _rate(counters.items, wall),
+                    'wall_bytes_per_sec': _rate(counters.bytes, wall),
+                    'latency_histogram': histogram}
+        return summary
+
+    def prometheus(self):
+        """ Returns the counters in the Prometheus text exposition format"""
+        summary = self.summary()
+        lines = ['# HELP {}_seconds Time taken by each run of a stage.'
+                 .format(PROMETHEUS_PREFIX),
+                 '# TYPE {}_seconds histogram'.format(PROMETHEUS_PREFIX)]
+        for stage, counters in summary.items():
+            for bound, count in counters['latency_histogram'].items():
+                lines.append('{}_seconds_bucket{{stage="{}",le="{}"}} {}'
+                             .format(PROMETHEUS_PREFIX, stage, bound, count))
+            lines.append('{}_seconds_sum{{stage="{}"}} {!r}'.format(
+                PROMETHEUS_PREFIX, stage, counters['seconds']))
+            lines.append('{}_seconds_count{{stage="{}"}} {}'
+                         .format(PROMETHEUS_PREFIX, stage, counters['count']))
+        for counter, description in (('items', 'Items handled'),
+                                     ('bytes', 'Bytes handled'),
+                                     ('errors', 'Failed runs')):
+            lines.append('# HELP {}_{}_total {} by each stage.'
+                         .format(PROMETHEUS_PREFIX, counter, description))
+            lines.append('# TYPE {}_{}_total counter'
+                         .format(PROMETHEUS_PREFIX, counter))
+            for stage, counters in summary.items():
+                lines.append('{}_{}_total{{stage="{}"}} {}'.format(
+                    PROMETHEUS_PREFIX, counter, stage, counters[counter]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """ Writes the counters to filename, atomically, in the Prometheus
+        textfile format if its name ends in .prom, otherwise as JSON.
+        """
+        if filename.endswith('.prom'):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.summary(), indent=2) + '\n'
+        storage.write_file(filename, [content.encode('utf-8')])
+
+
+def _rate(count, seconds):
+    return count / seconds if seconds else None
@@ -0,0 +1,171 @@
+"""This module provides transparent compressed storage for the downloaded
+RSS feeds and xbrl filings. Files may be stored as is, gzip compressed with a
+.gz suffix or, when the optional zstandard package is installed, zstd
+compressed with a .zst suffix.
+
+:copyright: (c) 2017 by Robert Rennison
+:license: Apache 2, see LICENCE for more details
+"""
+
+import gzip
+import hashlib
+import os
+import tempfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The filename suffix used for each compression
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+# Stored files are copied in chunks of this many bytes
+CHUNK_SIZE = 1024 * 1024
+
+
+def check_compression(compression):
+    """ Raises ValueError if compression, None for uncompressed storage, is
+    not supported.
+    """
+    if compression is not None and compression not in SUFFIXES:
+        raise ValueError('Unknown compression {}, expected one of {}'
+                         .format(compression, ', '.join(sorted(SUFFIXES))))
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression requires the zstandard package')
+
+
+def stored_name(filename, compression):
+    """ Returns the name filename is stored under with compression"""
+    return filename + SUFFIXES.get(compression, '')
+
+
+def find_file(filename):
+    """ Returns the name of the stored copy of filename, whether it is
+    uncompressed or compressed, or None if there is no stored copy.
+    """
+    for suffix in ('',) + tuple(SUFFIXES.values()):
+        if os.path.exists(filename + suffix):
+            return filename + suffix
+    return None
+
+
+def logical_name(filename):
+    """ Returns the name of the file filename stores, without the suffix of
+    any compression.
+    """
+    for suffix in SUFFIXES.values():
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def stored_variants(filename):
+    """ Returns the names of every stored copy of filename"""
+    return [filename + suffix
+            for suffix in ('',) + tuple(SUFFIXES.values())
+            if os.path.exists(filename + suffix)]
+
+
+def open_file(filename):
+    """ Opens a stored file for reading its uncompressed bytes, choosing
+    the decompression from the filename suffix.
+    """
+    if filename.endswith(SUFFIXES['gzip']):
+        return gzip.open(filename, 'rb')
+    if filename.endswith(SUFFIXES['zstd']):
+        if zstandard is None:
+            raise ValueError('Reading {} requires the zstandard package'
+                             .format(filename))
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(filename, 'rb'), closefd=True)
+    return open(filename, 'rb')
+
+
+class _HashingWriter():
+    """ A binary file wrapper counting and hashing the bytes written"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        self.sha256.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+class _Compressor():
+    """ Writes to a file object through the given compression"""
+    def __init__(self, fileobj, compression):
+        self.fileobj = fileobj
+        if compression == 'gzip':
+            # A fixed mtime keeps the output, and so its hash, reproducible
+            self.writer = gzip.GzipFile(fileobj=fileobj, mode='wb', mtime=0)
+        elif compression == 'zstd':
+            self.writer = zstandard.ZstdCompressor().stream_writer(
+                fileobj, closefd=False)
+        else:
+            self.writer = None
+
+    def write(self, data):
+        if self.writer is None:
+            return self.fileobj.write(data)
+        return self.writer.write(data)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def write_file(filename, chunks, compression=None):
+    """ Writes chunks of bytes to filename, compressed as given, atomically
+
+    The chunks are written to a temporary file alongside filename which is
+    renamed into place only once complete, and removed if writing fails, so
+    that filename is never left truncated.
+
+    Args:
+        filename (str): The name to store the file under, including any
+            compression suffix.
+        chunks (iterable): The uncompressed content, as bytes.
+        compression (str): 'gzip', 'zstd' or None.
+
+    Returns:
+        (size, sha256) (tuple): The size and SHA-256 hex digest of the file
+        as stored.
+    """
+    fd, part_file = tempfile.mkstemp(
+        dir=os.path.dirname(filename) or '.',
+        prefix='.' + os.path.basename(filename) + '.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writer = _HashingWriter(f)
+            compressor = _Compressor(writer, compression)
+            for chunk in chunks:
+                compressor.write(chunk)
+            compressor.close()
+        os.replace(part_file, filename)
+    except BaseException:
+        os.remove(part_file)
+        raise
+    return writer.size, writer.sha256.hexdigest()
+
+
+def compress_file(filename, compression):
+    """ Compresses a stored, uncompressed, file in place
+
+    Returns:
+        (stored_filename, size, sha256) (tuple): The name of the compressed
+        file, and its size and SHA-256 hex digest.
+    """
+    compressed = stored_name(filename, compression)
+    with open(filename, 'rb') as f:
+        size, sha256 = write_file(
+            compressed, iter(lambda: f.read(CHUNK_SIZE), b''),
+            compression)
+    os.remove(filename)
+    return compressed, size, sha256
@@ -41,6 +41,11 @@ setup(
     },
     include_package_data=True,
     install_requires=requirements,
+    python_requires='>=3.7',
+    extras_require={
+        'zstd': ['zstandard'],
+        'parquet': ['pyarrow'],
+    },
     license="Apache Software License 2.0",
     zip_safe=False,
     keywords='sec_edgar_download',
@@ -49,11 +54,13 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: Apache Software License',
         'Natural Language :: English',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
     test_suite='tests',
     tests_require=test_requirements
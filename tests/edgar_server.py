@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+edgar_server
+----------------------------------
+
+A local stand-in for the parts of the SEC edgar website used by
+sec_edgar_download, so that the downloads can be tested, and load tested,
+without network access. Point a SecIndexer at it with
+SecIndexer(work_dir, base_url=server.base_url).
+
+It serves
+  /Archives/edgar/monthly/xbrlrss-YYYY-MM.xml  the feeds added by add_feed()
+  /cgi-bin/browse-edgar                        the CIKs added by add_cik()
+  any other path                               the files added by add_file()
+
+Feeds written with the server's base_url in their filing URLs, such as
+those generated by benchmarks.feedgen, have their filings served too.
+Responses may be slowed by a fixed latency and a bandwidth cap, and
+failures injected either for given paths, with fail(), or at random.
+"""
+
+import hashlib
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# An injected failure which sends half of the response, then closes the
+# connection
+DROP = 'drop'
+
+# Responses are written in chunks of this many bytes
+CHUNK_SIZE = 16 * 1024
+
+BROWSE_EDGAR = '''<?xml version="1.0" encoding="ISO-8859-1" ?>
+<companyFilings>
+<companyInfo>
+<CIK>{cik}</CIK>
+<name>{name}</name>
+</companyInfo>
+</companyFilings>
+'''
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        edgar = self.server.edgar
+        path = urlsplit(self.path).path
+        edgar._begin(path)
+        status = None
+        try:
+            if edgar.latency:
+                time.sleep(edgar.latency)
+            outcome = edgar._outcome(path)
+            content = edgar._content(self.path)
+            if outcome == DROP:
+                status = DROP
+                self._send(200, content or b'dropped', drop=True)
+            elif outcome is not None:
+                status = outcome
+                self._send(outcome, b'injected failure', edgar.retry_after)
+            elif content is None:
+                status = 404
+                self._send(404, b'not found')
+            elif self.headers.get('If-None-Match') == _etag(content):
+                status = 304
+                self._send(304, b'')
+            else:
+                status = 200
+                self._send(200, content)
+        finally:
+            edgar._end(path, status)
+
+    def _send(self, status, content, retry_after=None, drop=False):
+        self.send_response(status)
+        if status == 200 or status == 304:
+            self.send_header('ETag', _etag(content))
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        if status != 304:
+            self.send_header('Content-Length', str(len(content)))
+        if drop:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        if status == 304:
+            return
+        if drop:
+            content = content[:len(content) // 2]
+            self.close_connection = True
+        self._write(content)
+
+    def _write(self, content):
+        bandwidth = self.server.edgar.bandwidth
+        for start in range(0, len(content), CHUNK_SIZE):
+            chunk = content[start:start + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            if bandwidth:
+                self.wfile.flush()
+                time.sleep(len(chunk) / bandwidth)
+
+
+def _etag(content):
+    return '"{}"'.format(hashlib.sha1(content).hexdigest()[:16])
+
+
+class EdgarServer():
+    """A local HTTP server standing in for the edgar website.
+
+    The server listens on a free port of 127.0.0.1 while started, use it as
+    a context manager or call start() and stop(). It records the path and
+    status of every response in `requests`, injected failures as their
+    status or DROP, and the peak number of requests in flight in `peak`.
+
+    Args:
+        latency (float): Seconds to wait before each response.
+        bandwidth (float): Bytes per second each response is limited to.
+        error_rate (float): Fraction of requests failed with one of
+            error_statuses, at random.
+        drop_rate (float): Fraction of requests whose connection is dropped
+            half way through the response, at random.
+        error_statuses (tuple): The statuses of the random failures.
+        retry_after (int): The Retry-After header sent with injected
+            failures, if any.
+        seed (int): Seed for the random failures.
+    """
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0,
+                 drop_rate=0.0, error_statuses=(429, 503), retry_after=None,
+                 seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.error_statuses = error_statuses
+        self.retry_after = retry_after
+        self.files = {}
+        self.ciks = {}
+        self.faults = {}
+        self.requests = []
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.edgar = self
+        self._thread = None
+        self.base_url = 'http://127.0.0.1:{}'.format(
+            self._httpd.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def url(self, path):
+        """ Returns the URL of path on the server"""
+        return self.base_url + path
+
+    def add_file(self, path, content):
+        """ Serves content, bytes or str, at path"""
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        self.files[path] = content
+        return path
+
+    def add_feed(self, year, month, content):
+        """ Serves content as the feed of year and month, returning its path
+        """
+        return self.add_file('/Archives/edgar/monthly/xbrlrss-{}-{:02}.xml'
+                             .format(year, month), content)
+
+    def add_cik(self, ticker, cik, name=''):
+        """ Answers browse-edgar queries for ticker with cik"""
+        self.ciks[ticker.upper()] = BROWSE_EDGAR.format(
+            cik='{:010d}'.format(int(cik)), name=name).encode('utf-8')
+
+    def fail(self, path, *outcomes):
+        """ Fails the next requests for path, one per outcome, each an HTTP
+        status or DROP.
+        """
+        with self._lock:
+            self.faults.setdefault(path, []).extend(outcomes)
+
+    def count(self, path, status=200):
+        """ Returns the number of responses for path with status"""
+        with self._lock:
+            return self.requests.count((path, status))
+
+    def _content(self, request_path):
+        url = urlsplit(request_path)
+        if url.path == '/cgi-bin/browse-edgar':
+            ticker = parse_qs(url.query).get('CIK', [''])[0]
+            return self.ciks.get(ticker.upper())
+        return self.files.get(url.path)
+
+    def _outcome(self, path):
+        with self._lock:
+            if self.faults.get(path):
+                return self.faults[path].pop(0)
+            if self._rng.random() < self.drop_rate:
+                return DROP
+            if self._rng.random() < self.error_rate:
+                return self._rng.choice(self.error_statuses)
+        return None
+
+    def _begin(self, path):
+        with self._lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+
+    def _end(self, path, status):
+        with self._lock:
+            self.in_flight -= 1
+            self.requests.append((path, status))
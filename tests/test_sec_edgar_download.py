@@ -9,9 +9,21 @@ Tests for `sec_edgar_download` module.
 """
 
 import os
+import re
 import filecmp
+import gzip
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import types
+import pandas as pd
 import pytest
-from sec_edgar_download  import indexer
+import requests
+from sec_edgar_download  import cli, downloader, indexer, storage
+from benchmarks import bench_import
+from tests.edgar_server import DROP, EdgarServer
 
 @pytest.fixture
 def response():
@@ -22,6 +34,19 @@ def response():
     # return requests.get('https://github.com/audreyr/cookiecutter-pypackage')
 
 
+@pytest.fixture(autouse=True)
+def quick_backoff(monkeypatch):
+    """Retries failed requests without the backoff used with the SEC"""
+    monkeypatch.setattr(downloader.RequestScheduler, 'backoff', 0.001)
+
+
+@pytest.fixture
+def edgar_server():
+    """A local stand-in for the edgar website, see tests/edgar_server.py"""
+    with EdgarServer() as server:
+        yield server
+
+
 def test_get_cik():
     cik = indexer.get_cik('intc')
     assert(cik == '0000050863')
@@ -39,7 +64,7 @@ def test_get_10k(tmpdir):
     ix.download_sec_feeds(2016,2016,1, 2)
     cik = indexer.get_cik('intc')
     files = ix.download_xbrl_data(cik, 2016, 2016,form_type='10-K'  )
-    xbrl_file_should_be = os.path.join(ix.filings_dir,'intc-20151226.xml')   
+    xbrl_file_should_be = files[0].filename
     assert(filecmp.cmp('tests/intc-20151226.xml',xbrl_file_should_be))
 
 
@@ -50,3 +75,882 @@ def test_get_10k(tmpdir):
 #    assert p.read() == "content"
 #    assert len(tmpdir.listdir()) == 1
     #assert 0
+
+
+ITEM_TEMPLATE = """<item>
+<title>{name} ({cik}) (Filer)</title>
+<description>{form}</description>
+<edgar:xbrlFiling xmlns:edgar="http://www.sec.gov/Archives/edgar">
+<edgar:companyName>{name}</edgar:companyName>
+<edgar:formType>{form}</edgar:formType>
+<edgar:filingDate>{date}</edgar:filingDate>
+<edgar:cikNumber>{cik}</edgar:cikNumber>
+<edgar:accessionNumber>{accession}</edgar:accessionNumber>
+<edgar:fileNumber>000-06217</edgar:fileNumber>
+<edgar:acceptanceDatetime>20160212161454</edgar:acceptanceDatetime>
+<edgar:period>20151226</edgar:period>
+<edgar:assistantDirector>Office of Electronics</edgar:assistantDirector>
+<edgar:assignedSic>3674</edgar:assignedSic>
+<edgar:fiscalYearEnd>1226</edgar:fiscalYearEnd>
+<edgar:xbrlFiles>
+<edgar:xbrlFile edgar:sequence="1" edgar:type="EX-101.SCH"
+    edgar:url="{url_base}.xsd" />
+<edgar:xbrlFile edgar:sequence="2" edgar:type="EX-101.INS"
+    edgar:url="{url_base}.xml" />
+</edgar:xbrlFiles>
+</edgar:xbrlFiling>
+</item>
+"""
+
+
+def stored_files(directory):
+    """Returns the paths, relative to directory, of the files within it"""
+    return sorted(os.path.relpath(os.path.join(path, filename), directory)
+                  for path, _, filenames in os.walk(directory)
+                  for filename in filenames)
+
+
+def write_feed(filename, items, host='http://www.sec.gov'):
+    """Writes a small RSS feed in the format used by the Edgar xbrlrss feeds.
+    Each item is a dict with name, cik, form, date and accession keys.
+    """
+    with open(str(filename), 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<rss version="2.0"><channel>\n'
+                '<title>All XBRL Data Submitted to the SEC</title>\n')
+        for item in items:
+            url_base = ('{}/Archives/edgar/data/{}/{}/x-{}'
+                        .format(host, int(item['cik']), item['accession'],
+                                item['accession']))
+            f.write(ITEM_TEMPLATE.format(url_base=url_base, **item))
+        f.write('</channel></rss>\n')
+    return str(filename)
+
+
+INTC_10K = {'name': 'INTEL CORP', 'cik': '0000050863', 'form': '10-K',
+            'date': '02/12/2016', 'accession': '0000050863-16-000105'}
+INTC_10Q = {'name': 'INTEL CORP', 'cik': '0000050863', 'form': '10-Q',
+            'date': '04/29/2016', 'accession': '0000050863-16-000125'}
+AAPL_10Q = {'name': 'APPLE INC', 'cik': '0000320193', 'form': '10-Q',
+            'date': '04/27/2016', 'accession': '0000320193-16-000067'}
+
+
+def read_feeds(ix):
+    conn = sqlite3.connect(ix.database)
+    rows = conn.execute('SELECT accession_number, form_type FROM feeds '
+                        'ORDER BY accession_number').fetchall()
+    conn.close()
+    return rows
+
+
+def test_save_upserts_months(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    feb = write_feed(tmpdir.join('feb.xml'), [INTC_10K])
+    apr = write_feed(tmpdir.join('apr.xml'), [INTC_10Q, AAPL_10Q])
+    ix._save_dict_to_database(ix.parse_sec_rss_feeds(feb))
+    ix._save_dict_to_database(ix.parse_sec_rss_feeds(apr))
+    # Saving a month again must neither duplicate nor drop other months
+    changed = dict(INTC_10Q, form='10-Q/A')
+    apr = write_feed(tmpdir.join('apr.xml'), [changed, AAPL_10Q])
+    ix._save_dict_to_database(ix.parse_sec_rss_feeds(apr))
+    assert read_feeds(ix) == [('0000050863-16-000105', '10-K'),
+                              ('0000050863-16-000125', '10-Q/A'),
+                              ('0000320193-16-000067', '10-Q')]
+
+
+def test_save_rows_to_database(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K, INTC_10Q])
+    rows = ix.parse_sec_rss_rows(feed)
+    assert rows[0][ix.edgar_keys.index('accession_number')] == (
+        '0000050863-16-000105')
+    assert ix.parse_sec_rss_feeds(feed) == {
+        key: list(column) for key, column in zip(ix.edgar_keys, zip(*rows))}
+    # Rows may be streamed, the first of any repeated filing is kept
+    changed = rows[0][:1] + ('10-K/A',) + rows[0][2:]
+    assert ix._save_rows_to_database(iter(rows + [changed])) == 2
+    assert read_feeds(ix) == [('0000050863-16-000105', '10-K'),
+                              ('0000050863-16-000125', '10-Q')]
+    assert ix.search_companies('intel') == [('0000050863', 'INTEL CORP')]
+
+
+def test_parse_filings(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    feb = write_feed(tmpdir.join('feb.xml'), [INTC_10K, AAPL_10Q])
+    apr = write_feed(tmpdir.join('apr.xml'), [INTC_10Q])
+    intc_10k, aapl_10q = ix.parse_sec_rss_rows(feb)
+    intc_10q, = ix.parse_sec_rss_rows(apr)
+    assert isinstance(intc_10k, indexer.Filing)
+    assert intc_10k.form_type == '10-K'
+    assert intc_10k.filing_date == '2016-02-12'
+    assert intc_10k._asdict() == next(ix.iter_sec_rss_feed(feb))
+    # The categorical values are shared between filings, and between months
+    assert aapl_10q.assigned_sic is intc_10k.assigned_sic
+    assert intc_10q.assistant_director is intc_10k.assistant_director
+    # and a company's between its filings in a month
+    intc_10k, intc_10q = ix.parse_sec_rss_rows(
+        write_feed(tmpdir.join('intc.xml'), [INTC_10K, INTC_10Q]))
+    assert intc_10q.company_name is intc_10k.company_name
+    assert intc_10q.cik_number is intc_10k.cik_number
+    assert intc_10q.accession_number != intc_10k.accession_number
+
+
+def test_prep_database_adds_primary_key(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    feb = write_feed(tmpdir.join('feb.xml'), [INTC_10K, INTC_10K])
+    # Tables written by the old to_sql(if_exists="replace") had no key
+    conn = sqlite3.connect(ix.database)
+    conn.execute('DROP TABLE feeds')
+    conn.commit()
+    pd.DataFrame(ix.parse_sec_rss_feeds(feb)).to_sql('feeds', conn)
+    conn.close()
+    ix = indexer.SecIndexer(str(tmpdir))
+    ix._save_dict_to_database(ix.parse_sec_rss_feeds(feb))
+    assert read_feeds(ix) == [('0000050863-16-000105', '10-K')]
+
+
+def test_parse_sec_rss_feeds(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K, AAPL_10Q])
+    edgar_dict = ix.parse_sec_rss_feeds(feed)
+    assert edgar_dict['accession_number'] == ['0000050863-16-000105',
+                                              '0000320193-16-000067']
+    assert edgar_dict['company_name'] == ['INTEL CORP', 'APPLE INC']
+    assert edgar_dict['assigned_sic'] == ['3674', '3674']
+    assert edgar_dict['xbrl_files'][0] == (
+        'http://www.sec.gov/Archives/edgar/data/50863/0000050863-16-000105/'
+        'x-0000050863-16-000105.xml')
+    records = list(ix.iter_sec_rss_feed(feed))
+    assert [r['form_type'] for r in records] == ['10-K', '10-Q']
+
+
+def test_parse_sec_rss_feeds_missing_fields(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K])
+    with open(feed) as f:
+        content = f.read()
+    content = re.sub('<edgar:period>.*</edgar:period>\n', '', content)
+    content = content.replace('EX-101.INS', 'EX-101.LAB')
+    with open(feed, 'w') as f:
+        f.write(content)
+    record = next(ix.iter_sec_rss_feed(feed))
+    assert record['period'] is None
+    assert record['xbrl_files'] is None
+    assert record['fiscal_year_end'] == '1226'
+
+
+def test_download_sec_feeds_concurrently(tmpdir, monkeypatch):
+    ix = indexer.SecIndexer(str(tmpdir), jobs=3)
+    months = {(2016, 2): [INTC_10K], (2016, 3): [],
+              (2016, 4): [INTC_10Q, AAPL_10Q]}
+    downloaded = []
+
+    def download_sec_feed(year, month, refresh):
+        downloaded.append((year, month))
+        filename = tmpdir.join('xbrlrss-{}-{:02}.xml'.format(year, month))
+        return write_feed(filename, months[(year, month)])
+
+    monkeypatch.setattr(ix, '_download_sec_feed', download_sec_feed)
+    ix.download_sec_feeds(2016, 2016, 2, 4)
+    assert sorted(downloaded) == sorted(months)
+    assert len(read_feeds(ix)) == 3
+
+
+def test_ingest_sec_feeds(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    write_feed(os.path.join(ix.feed_dir, 'xbrlrss-2016-02.xml'), [INTC_10K])
+    write_feed(os.path.join(ix.feed_dir, 'xbrlrss-2016-04.xml'),
+               [INTC_10Q, AAPL_10Q])
+    write_feed(os.path.join(ix.feed_dir, 'xbrlrss-2016-05.xml'), [AAPL_10Q])
+    write_feed(os.path.join(ix.feed_dir, 'notes.xml'), [])
+    ingested = ix.ingest_sec_feeds(2016, 2016, 1, 4, jobs=2)
+    assert [os.path.basename(f) for f in ingested] == [
+        'xbrlrss-2016-02.xml', 'xbrlrss-2016-04.xml']
+    assert len(read_feeds(ix)) == 3
+
+
+def test_token_bucket_limits_rate():
+    bucket = downloader.TokenBucket(rate=50, capacity=5)
+    start = time.monotonic()
+    for _ in range(15):
+        bucket.acquire()
+    # The first 5 are a burst, the other 10 are spaced at 50/sec
+    assert time.monotonic() - start >= 0.18
+
+
+def fake_response(content, status_code=200, headers=None):
+    """Stands in for a streamed requests.Response"""
+    def iter_content(chunk_size):
+        for start in range(0, len(content), chunk_size):
+            yield content[start:start + chunk_size]
+    return types.SimpleNamespace(status_code=status_code,
+                                 headers=headers or {},
+                                 iter_content=iter_content,
+                                 raise_for_status=lambda: None,
+                                 close=lambda: None)
+
+
+class FakeSession():
+    """Stands in for a requests.Session, recording the peak concurrency"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+        self.urls = []
+        self.fail = ('missing.xml',)
+
+    def get(self, url, **kwargs):
+        with self.lock:
+            self.urls.append(url)
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(0.02)
+        with self.lock:
+            self.in_flight -= 1
+        if url.endswith(self.fail):
+            raise requests.exceptions.ConnectionError(url)
+        return fake_response(url.encode(), headers={'ETag': '"1"'})
+
+
+def test_download_files(tmpdir):
+    session = FakeSession()
+    downloads = [('http://sec/{}.xml'.format(n), str(tmpdir.join(str(n))))
+                 for n in range(12)]
+    downloads.append(('http://sec/missing.xml', str(tmpdir.join('missing'))))
+    results = downloader.download_files(
+        session, downloads, concurrency=3,
+        limiter=downloader.TokenBucket(rate=1000))
+    assert session.peak == 3
+    assert [r.url for r in results] == [url for url, _ in downloads]
+    assert [r.url for r in results if r.error] == ['http://sec/missing.xml']
+    assert tmpdir.join('11').read() == 'http://sec/11.xml'
+
+
+def test_select_xbrl_urls(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    feed = write_feed(tmpdir.join('feed.xml'),
+                      [INTC_10K, INTC_10Q, AAPL_10Q,
+                       dict(INTC_10Q, date='04/28/2017',
+                            accession='0000050863-17-000012')])
+    ix._save_dict_to_database(ix.parse_sec_rss_feeds(feed))
+    urls = ix._select_xbrl_urls([50863], 2016, 2016)
+    assert [os.path.basename(url) for _, url in urls] == [
+        'x-0000050863-16-000105.xml', 'x-0000050863-16-000125.xml']
+    assert len(ix._select_xbrl_urls(['0000050863', 320193, '50863'],
+                                    2016, 2017, '10-Q')) == 3
+
+    # An instance document listed by two filings is returned once
+    feb = write_feed(tmpdir.join('feb.xml'),
+                     [dict(INTC_10K, accession='0000050863-16-000999')])
+    rows = ix.parse_sec_rss_rows(feb)
+    ix._save_rows_to_database(
+        row._replace(xbrl_files=urls[0][1]) for row in rows)
+    assert sorted(url for _, url in ix._select_xbrl_urls(
+        [50863], 2016, 2016)) == [url for _, url in urls]
+
+    # Each CIK is looked up through the (cik_number, form_type, filing_date)
+    # index, with or without a form type
+    conn = sqlite3.connect(ix.database)
+    conn.execute('CREATE TEMP TABLE batch_ciks (cik_number PRIMARY KEY)')
+    for form_type in ('All', '10-K'):
+        query, params = indexer._xbrl_urls_query(2016, 2016, form_type)
+        plan = str(conn.execute('EXPLAIN QUERY PLAN ' + query,
+                                params).fetchall())
+        assert 'feeds_cik_form_date (cik_number=?' in plan
+        assert 'feeds_form_type' not in plan
+    conn.close()
+
+
+def test_dates_stored_in_iso_form(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K])
+    record = next(ix.iter_sec_rss_feed(feed))
+    assert record['filing_date'] == '2016-02-12'
+    assert record['acceptance_datetime'] == '2016-02-12T16:14:54'
+
+    # A database from before the dates were converted is migrated once
+    conn = sqlite3.connect(ix.database)
+    conn.execute('PRAGMA user_version = 0')
+    conn.execute("INSERT INTO feeds (accession_number, filing_date, "
+                 "acceptance_datetime) VALUES ('1', '12/30/2016', "
+                 "'20161230172248')")
+    conn.commit()
+    conn.close()
+    ix = indexer.SecIndexer(str(tmpdir))
+    conn = sqlite3.connect(ix.database)
+    assert conn.execute('SELECT filing_date, acceptance_datetime FROM feeds'
+                        ).fetchall() == [('2016-12-30', '2016-12-30T17:22:48')]
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 5
+    assert conn.execute('SELECT month FROM partitions').fetchall() == [
+        ('2016-12',)]
+    conn.close()
+
+
+def test_cik_cache(tmpdir, monkeypatch):
+    tickers_json = tmpdir.join('company_tickers.json')
+    tickers_json.write(json.dumps({
+        '0': {'cik_str': 320193, 'ticker': 'AAPL', 'title': 'Apple Inc.'},
+        '1': {'cik_str': 50863, 'ticker': 'INTC', 'title': 'INTEL CORP'}}))
+    looked_up = []
+
+    def get_cik(ticker, base_url, session):
+        looked_up.append(ticker)
+        return '0000789019'
+
+    monkeypatch.setattr(indexer, 'get_cik', get_cik)
+    ix = indexer.SecIndexer(str(tmpdir))
+    assert ix.load_company_tickers(str(tickers_json)) == 2
+    assert ix.get_ciks(['aapl\n', 'INTC', 'msft']) == {
+        'AAPL': '0000320193', 'INTC': '0000050863', 'MSFT': '0000789019'}
+    assert ix.get_cik('msft') == '0000789019'
+    assert looked_up == ['MSFT']
+
+    ix = indexer.SecIndexer(str(tmpdir), cik_ttl=-1)
+    assert ix.get_cik('intc') == '0000789019'
+    assert looked_up == ['MSFT', 'INTC']
+
+
+def test_get_ciks_skips_unknown_tickers(tmpdir, edgar_server):
+    edgar_server.add_cik('intc', 50863)
+    edgar_server.add_cik('aapl', 320193)
+    # Edgar answers an unknown ticker with a page holding no CIK
+    edgar_server.ciks['NOPE'] = b'<companyFilings></companyFilings>'
+    with pytest.raises(ValueError):
+        indexer.get_cik('nope', edgar_server.base_url)
+
+    ix = indexer.SecIndexer(str(tmpdir), base_url=edgar_server.base_url)
+    assert ix.get_ciks(['intc', 'nope', 'gone', 'aapl']) == {
+        'AAPL': '0000320193', 'INTC': '0000050863'}
+    conn = sqlite3.connect(ix.database)
+    assert conn.execute('SELECT ticker, cik_number FROM ciks ORDER BY '
+                        'ticker').fetchall() == [('AAPL', '0000320193'),
+                                                 ('INTC', '0000050863')]
+    conn.close()
+    with pytest.raises(ValueError):
+        ix.get_cik('gone')
+
+
+def test_download_xbrl_batch(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir), jobs=2)
+    ix.session = FakeSession()
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K, INTC_10Q, AAPL_10Q])
+    ix._save_dict_to_database(ix.parse_sec_rss_feeds(feed))
+    results = ix.download_xbrl_batch(['0000050863', 50863, 320193, 1234],
+                                     2016, 2016, '10-Q')
+    assert sorted(os.path.basename(r.filename) for r in results) == [
+        'x-0000050863-16-000125.xml', 'x-0000320193-16-000067.xml']
+    assert not any(r.error for r in results)
+
+
+def test_download_xbrl_batch_resumes(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    ix.session = FakeSession()
+    ix.session.fail = ('000125.xml',)
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K, INTC_10Q])
+    ix._save_dict_to_database(ix.parse_sec_rss_feeds(feed))
+    results = ix.download_xbrl_data(50863, 2016, 2016)
+    assert [r.error is None for r in results] == [True, False]
+
+    conn = sqlite3.connect(ix.database)
+    rows = conn.execute('SELECT accession_number, status, size, etag '
+                        'FROM downloads ORDER BY url').fetchall()
+    conn.close()
+    assert rows == [('0000050863-16-000105', 'complete', 92, '"1"'),
+                    ('0000050863-16-000125', 'failed', None, None)]
+
+    # Only the failed download, and one whose file has gone, are retried
+    ix.session = FakeSession()
+    ix.download_xbrl_data(50863, 2016, 2016)
+    assert [os.path.basename(url) for url in ix.session.urls] == [
+        'x-0000050863-16-000125.xml']
+    os.remove(results[0].filename)
+    ix.session = FakeSession()
+    ix.download_xbrl_data(50863, 2016, 2016)
+    assert [os.path.basename(url) for url in ix.session.urls] == [
+        'x-0000050863-16-000105.xml']
+
+
+def test_filings_sharing_a_file_name(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    feed = write_feed(tmpdir.join('feed.xml'), [
+        INTC_10K, dict(INTC_10K, form='10-K/A',
+                       accession='0000050863-16-000200')])
+    # An original and its amendment whose instance documents share a name
+    ix._save_rows_to_database(
+        row._replace(xbrl_files='http://www.sec.gov/Archives/{}/'
+                     'intc-20151226.xml'.format(row.accession_number))
+        for row in ix.parse_sec_rss_rows(feed))
+    ix.session = FakeSession()
+    results = ix.download_xbrl_data(50863, 2016, 2016)
+    assert [r.error for r in results] == [None, None]
+    assert stored_files(ix.filings_dir) == [
+        os.path.join('0000050863-16-000105', 'intc-20151226.xml'),
+        os.path.join('0000050863-16-000200', 'intc-20151226.xml')]
+    # so both are recognised as downloaded
+    ix.session = FakeSession()
+    assert ix.download_xbrl_data(50863, 2016, 2016) == []
+    assert ix.session.urls == []
+
+
+class FeedSession():
+    """Stands in for a requests.Session serving one feed, which honours
+    If-None-Match conditional requests"""
+    def __init__(self, content, etag):
+        self.content = content
+        self.etag = etag
+        self.status_codes = []
+
+    def get(self, url, headers=None, **kwargs):
+        status_code = 200
+        if (headers or {}).get('If-None-Match') == self.etag:
+            status_code = 304
+        self.status_codes.append(status_code)
+        return fake_response(self.content, status_code, {'ETag': self.etag})
+
+
+def test_refresh_open_month(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    year, month = time.gmtime()[:2]
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K])
+    ix.session = FeedSession(open(feed, 'rb').read(), '"v1"')
+    ix.download_sec_feeds(year, year, month, month)
+    ix.download_sec_feeds(year, year, month, month)
+    ix.download_sec_feeds(year, year, month, month, refresh=True)
+    assert ix.session.status_codes == [200, 304]
+    assert len(read_feeds(ix)) == 1
+
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K, AAPL_10Q])
+    ix.session = FeedSession(open(feed, 'rb').read(), '"v2"')
+    ix.download_sec_feeds(year, year, month, month, refresh=True)
+    assert ix.session.status_codes == [200]
+    assert len(read_feeds(ix)) == 2
+
+    # Closed months are never refreshed
+    assert not indexer._is_open_month(year - 1, month)
+
+
+def test_unchanged_feed_not_yet_ingested(tmpdir, monkeypatch):
+    ix = indexer.SecIndexer(str(tmpdir))
+    year, month = time.gmtime()[:2]
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K])
+    ix.session = FeedSession(open(feed, 'rb').read(), '"v1"')
+
+    def crash(feed_file, state, rows):
+        raise RuntimeError('crashed before saving')
+
+    # The feed is downloaded, but never saved
+    monkeypatch.setattr(ix, '_save_feed', crash)
+    with pytest.raises(RuntimeError):
+        ix.download_sec_feeds(year, year, month, month)
+    monkeypatch.undo()
+
+    # so it is ingested although the refresh finds it unchanged
+    ix.download_sec_feeds(year, year, month, month, refresh=True)
+    assert ix.session.status_codes == [200, 304]
+    assert len(read_feeds(ix)) == 1
+
+
+def test_fetch_file_is_atomic(tmpdir):
+    filename = str(tmpdir.join('feed.xml'))
+    content = b'<rss>' + b'x' * 200000 + b'</rss>'
+    session = FeedSession(content, '"v1"')
+    result = downloader.fetch_file(session, 'http://sec/feed.xml', filename)
+    assert open(filename, 'rb').read() == content
+    assert result.size == len(content)
+    assert result.sha256 == hashlib.sha256(content).hexdigest()
+
+    def broken_iter_content(chunk_size):
+        yield b'<rss>'
+        raise requests.exceptions.ChunkedEncodingError('connection dropped')
+
+    response = fake_response(b'')
+    response.iter_content = broken_iter_content
+    session.get = lambda url, **kwargs: response
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        downloader.fetch_file(session, 'http://sec/feed.xml', filename)
+    assert open(filename, 'rb').read() == content
+    assert os.listdir(str(tmpdir)) == ['feed.xml']
+
+
+def test_compressed_storage(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir), compression='gzip')
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K])
+    ix.session = FeedSession(open(feed, 'rb').read(), '"v1"')
+    ix.download_sec_feeds(2016, 2016, 2, 2)
+    feed_file = os.path.join(ix.feed_dir, 'xbrlrss-2016-02.xml.gz')
+    assert gzip.open(feed_file).read() == open(feed, 'rb').read()
+    assert ix.ingest_sec_feeds(jobs=1, force=True) == [feed_file]
+    assert len(read_feeds(ix)) == 1
+
+    ix.session = FakeSession()
+    results = ix.download_xbrl_data(50863, 2016, 2016)
+    assert results[0].filename.endswith('.xml.gz')
+
+
+def test_compress_work_dir(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K])
+    ix.session = FeedSession(open(feed, 'rb').read(), '"v1"')
+    ix.download_sec_feeds(2016, 2016, 2, 2)
+    ix.session = FakeSession()
+    ix.download_xbrl_data(50863, 2016, 2016)
+
+    assert ix.compress_work_dir() == 2
+    assert stored_files(ix.feed_dir) + stored_files(ix.filings_dir) == [
+        'xbrlrss-2016-02.xml.gz',
+        os.path.join('0000050863-16-000105',
+                     'x-0000050863-16-000105.xml.gz')]
+    # The compressed feed is recognised as already ingested
+    assert ix.ingest_sec_feeds(jobs=1) == []
+    assert ix.parse_sec_rss_feeds(os.path.join(
+        ix.feed_dir, 'xbrlrss-2016-02.xml.gz'))['form_type'] == ['10-K']
+    # The compressed files are recognised as already downloaded
+    ix.session = FakeSession()
+    ix.download_sec_feeds(2016, 2016, 2, 2)
+    ix.download_xbrl_data(50863, 2016, 2016)
+    assert ix.session.urls == []
+
+
+def test_feed_state_keyed_by_feed_name(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    feb = write_feed(os.path.join(ix.feed_dir, 'xbrlrss-2016-02.xml'),
+                     [INTC_10K])
+    ix.ingest_sec_feeds(jobs=1)
+    # Databases from before version 5 keyed it by the stored file name
+    conn = sqlite3.connect(ix.database)
+    conn.execute("UPDATE feed_state SET feed = feed || '.gz'")
+    conn.execute('PRAGMA user_version = 4')
+    conn.commit()
+    conn.close()
+    ix = indexer.SecIndexer(str(tmpdir))
+    assert ix.ingest_sec_feeds(jobs=1) == []
+    conn = sqlite3.connect(ix.database)
+    assert conn.execute('SELECT feed FROM feed_state').fetchall() == [
+        ('xbrlrss-2016-02.xml',)]
+    conn.close()
+    # The state of a feed is that of whichever copy was last ingested
+    with open(feb, 'rb') as f:
+        storage.write_file(feb + '.gz', [f.read()], 'gzip')
+    os.remove(feb)
+    assert ix.ingest_sec_feeds(jobs=1) == [feb + '.gz']
+    assert ix.ingest_sec_feeds(jobs=1) == []
+
+
+def test_unchanged_feeds_are_skipped(tmpdir, monkeypatch):
+    ix = indexer.SecIndexer(str(tmpdir))
+    feb = write_feed(os.path.join(ix.feed_dir, 'xbrlrss-2016-02.xml'),
+                     [INTC_10K])
+    apr = write_feed(os.path.join(ix.feed_dir, 'xbrlrss-2016-04.xml'),
+                     [INTC_10Q])
+    assert ix.ingest_sec_feeds(jobs=1) == [feb, apr]
+    assert ix.ingest_sec_feeds(jobs=1) == []
+
+    # Rewriting a feed with the same content changes its mtime, not its hash
+    write_feed(feb, [INTC_10K])
+    os.utime(feb, (0, 0))
+    write_feed(apr, [INTC_10Q, AAPL_10Q])
+    parsed = []
+
+    def parse_sec_rss_rows(feed_file):
+        parsed.append(feed_file)
+        return indexer._parse_sec_rss_rows(feed_file)
+
+    monkeypatch.setattr(ix, 'parse_sec_rss_rows', parse_sec_rss_rows)
+    ix.session = FakeSession()
+    ix.session.fail = ('xbrlrss-2016-03.xml',)
+    ix.download_sec_feeds(2016, 2016, 2, 4)
+    assert parsed == [apr]
+    assert len(read_feeds(ix)) == 3
+
+    conn = sqlite3.connect(ix.database)
+    assert conn.execute('SELECT feed, rows FROM feed_state ORDER BY feed'
+                        ).fetchall() == [('xbrlrss-2016-02.xml', 1),
+                                         ('xbrlrss-2016-04.xml', 2)]
+    conn.close()
+
+
+def test_export_feeds(tmpdir):
+    pytest.importorskip('pyarrow')
+    ix = indexer.SecIndexer(str(tmpdir))
+    write_feed(os.path.join(ix.feed_dir, 'xbrlrss-2016-02.xml'), [INTC_10K])
+    apr = write_feed(os.path.join(ix.feed_dir, 'xbrlrss-2016-04.xml'),
+                     [INTC_10Q])
+    ix.ingest_sec_feeds(jobs=1)
+    export_dir = str(tmpdir.join('export'))
+    assert ix.export_feeds(export_dir) == ['2016-02', '2016-04']
+    assert ix.export_feeds(export_dir) == []
+
+    # Only the month with new rows is exported again
+    write_feed(apr, [INTC_10Q, AAPL_10Q])
+    ix.ingest_sec_feeds(jobs=1)
+    assert ix.export_feeds(export_dir) == ['2016-04']
+    os.remove(os.path.join(export_dir, 'year=2016', 'month=02',
+                           'feeds.parquet'))
+    assert ix.export_feeds(export_dir) == ['2016-02']
+    assert len(ix.export_feeds(export_dir, full=True)) == 2
+
+    df = pd.read_parquet(export_dir)
+    assert sorted(df['accession_number']) == [
+        '0000050863-16-000105', '0000050863-16-000125',
+        '0000320193-16-000067']
+    assert df['form_type'].dtype.name == 'category'
+    assert str(df['filing_date'].dtype).startswith('datetime64')
+    assert sorted(df['month'].astype(int).unique()) == [2, 4]
+
+
+def test_search_companies(tmpdir):
+    ix = indexer.SecIndexer(str(tmpdir))
+    write_feed(os.path.join(ix.feed_dir, 'xbrlrss-2016-04.xml'),
+               [INTC_10Q, AAPL_10Q, dict(AAPL_10Q, name='APPLE COMPUTER INC',
+                                         accession='0000320193-16-000001')])
+    ix.ingest_sec_feeds(jobs=1)
+    assert ix.search_companies('intel') == [('0000050863', 'INTEL CORP')]
+    assert ix.search_companies('App inc') == [
+        ('0000320193', 'APPLE INC'), ('0000320193', 'APPLE COMPUTER INC')]
+    assert ix.search_companies('apple', limit=1) == [
+        ('0000320193', 'APPLE INC')]
+    assert ix.search_companies('corp inc') == []
+    assert ix.search_companies('"') == []
+
+    # Without the full text index the companies table is scanned
+    conn = sqlite3.connect(ix.database)
+    conn.execute('DROP TABLE company_names')
+    conn.close()
+    assert ix.search_companies('app inc') == [
+        ('0000320193', 'APPLE INC'), ('0000320193', 'APPLE COMPUTER INC')]
+
+    # and it is rebuilt when the database is next opened
+    ix = indexer.SecIndexer(str(tmpdir))
+    assert ix.search_companies('comp') == [
+        ('0000320193', 'APPLE COMPUTER INC')]
+
+
+def filing_path(item):
+    return '/Archives/edgar/data/{}/{}/x-{}.xml'.format(
+        int(item['cik']), item['accession'], item['accession'])
+
+
+def test_edgar_server(tmpdir, edgar_server):
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K, INTC_10Q],
+                      host=edgar_server.base_url)
+    feed_path = edgar_server.add_feed(2016, 2, open(feed, 'rb').read())
+    for item in (INTC_10K, INTC_10Q):
+        edgar_server.add_file(filing_path(item), item['accession'])
+    edgar_server.add_cik('intc', 50863, 'INTEL CORP')
+
+    ix = indexer.SecIndexer(str(tmpdir.join('edgar')), jobs=2,
+                            base_url=edgar_server.base_url)
+    assert ix.get_cik('intc') == '0000050863'
+    ix.download_sec_feeds(2016, 2016, 2, 2)
+    assert filecmp.cmp(feed, os.path.join(ix.feed_dir, 'xbrlrss-2016-02.xml'))
+    edgar_server.latency = 0.05
+    results = ix.download_xbrl_data('0000050863', 2016, 2016)
+    assert [open(r.filename).read() for r in results] == [
+        INTC_10K['accession'], INTC_10Q['accession']]
+    assert edgar_server.peak == 2
+    assert edgar_server.count(feed_path) == 1
+    assert edgar_server.count('/cgi-bin/browse-edgar') == 1
+
+
+def test_download_concurrency_follows_scheduler(tmpdir, edgar_server):
+    items = [dict(item, accession='{}-16-00010{}'.format(item['cik'], n))
+             for item in (INTC_10K, AAPL_10Q) for n in range(4)]
+    for item in items:
+        edgar_server.add_file(filing_path(item), item['accession'])
+    edgar_server.latency = 0.1
+    ix = indexer.SecIndexer(str(tmpdir.join('edgar')), rate_limit=1000)
+    feed = write_feed(tmpdir.join('feed.xml'), items,
+                      host=edgar_server.base_url)
+    ix._save_dict_to_database(ix.parse_sec_rss_feeds(feed))
+
+    # Without a cap from jobs, the scheduler's limit sets the concurrency
+    assert len(ix.download_xbrl_data(50863, 2016, 2016)) == 4
+    assert edgar_server.peak == 4
+    edgar_server.peak = 0
+    ix.scheduler.limit = 2
+    assert len(ix.download_xbrl_data(320193, 2016, 2016)) == 4
+    assert edgar_server.peak == 2
+
+
+def test_edgar_server_failures(tmpdir, edgar_server):
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K, INTC_10Q],
+                      host=edgar_server.base_url)
+    feed_path = edgar_server.add_feed(2016, 2, open(feed, 'rb').read())
+    for item in (INTC_10K, INTC_10Q):
+        edgar_server.add_file(filing_path(item), item['accession'] * 1000)
+    edgar_server.fail(feed_path, 503)
+    edgar_server.fail(filing_path(INTC_10K), 429)
+    edgar_server.fail(filing_path(INTC_10Q), DROP)
+
+    ix = indexer.SecIndexer(str(tmpdir.join('edgar')),
+                            base_url=edgar_server.base_url)
+    ix.scheduler.retries = 0
+    ix.download_sec_feeds(2016, 2016, 2, 2)
+    assert os.listdir(ix.feed_dir) == []
+    ix.download_sec_feeds(2016, 2016, 2, 2)
+    results = ix.download_xbrl_data(50863, 2016, 2016)
+    assert [type(r.error) for r in results] == [
+        requests.exceptions.HTTPError,
+        requests.exceptions.ChunkedEncodingError]
+    # Neither failure leaves a partial file behind, and both are retried
+    assert stored_files(ix.filings_dir) == []
+    results = ix.download_xbrl_data(50863, 2016, 2016)
+    assert [r.error for r in results] == [None, None]
+    assert edgar_server.requests.count((feed_path, 503)) == 1
+    assert edgar_server.requests.count((filing_path(INTC_10Q), DROP)) == 1
+
+
+def test_request_scheduler_retries(tmpdir, edgar_server):
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K, INTC_10Q],
+                      host=edgar_server.base_url)
+    feed_path = edgar_server.add_feed(2016, 2, open(feed, 'rb').read())
+    for item in (INTC_10K, INTC_10Q):
+        edgar_server.add_file(filing_path(item), item['accession'])
+    edgar_server.add_cik('intc', 50863)
+    edgar_server.fail(feed_path, 503, DROP)
+    edgar_server.fail(filing_path(INTC_10K), 429, 429)
+    edgar_server.fail(filing_path(INTC_10Q), 404)
+    edgar_server.fail('/cgi-bin/browse-edgar', 500)
+    edgar_server.retry_after = 0
+
+    ix = indexer.SecIndexer(str(tmpdir.join('edgar')), jobs=2,
+                            base_url=edgar_server.base_url)
+    assert ix.get_cik('intc') == '0000050863'
+    ix.download_sec_feeds(2016, 2016, 2, 2)
+    results = ix.download_xbrl_data(50863, 2016, 2016)
+    # A 404 is not retried
+    assert [type(r.error) for r in results] == [
+        type(None), requests.exceptions.HTTPError]
+    assert edgar_server.count(feed_path) == 1
+    assert edgar_server.count(filing_path(INTC_10K)) == 1
+    assert ix.scheduler.retried == 5
+    assert ix.scheduler.throttled == 3
+    assert ix.scheduler.limit < ix.max_jobs
+
+
+def test_request_scheduler_aimd():
+    scheduler = downloader.RequestScheduler(
+        downloader.TokenBucket(rate=1000), max_concurrency=8)
+    throttled = requests.exceptions.HTTPError(
+        response=fake_response(b'', 429, {'Retry-After': '0.05'}))
+    responses = [throttled, throttled]
+
+    def request():
+        if responses:
+            raise responses.pop(0)
+        return 'ok'
+
+    start = time.monotonic()
+    assert scheduler.run(request) == 'ok'
+    assert time.monotonic() - start >= 0.1
+    # Halved for each throttled response, then raised by 1 / limit
+    assert scheduler.limit == 2.5
+    for _ in range(5):
+        scheduler.run(request)
+    assert 4 < scheduler.limit < 4.2
+
+    limit = scheduler.limit
+    scheduler.retries = 0
+    responses.append(throttled)
+    with pytest.raises(requests.exceptions.HTTPError):
+        scheduler.run(request)
+    assert scheduler.limit == limit / 2
+    assert scheduler.retried == 2
+
+
+def test_stage_metrics(tmpdir, edgar_server):
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K, INTC_10Q],
+                      host=edgar_server.base_url)
+    edgar_server.add_feed(2016, 2, open(feed, 'rb').read())
+    edgar_server.add_file(filing_path(INTC_10K), 'x' * 100)
+    edgar_server.add_cik('intc', 50863)
+
+    ix = indexer.SecIndexer(str(tmpdir.join('edgar')),
+                            base_url=edgar_server.base_url)
+    ix.download_sec_feeds(2016, 2016, 2, 2)
+    ix.download_xbrl_data(ix.get_cik('intc'), 2016, 2016)
+    summary = ix.metrics.summary()
+    assert sorted(summary) == ['cik_lookup', 'feed_download',
+                               'filing_download', 'parse', 'save']
+    assert summary['feed_download']['bytes'] == os.path.getsize(feed)
+    assert summary['parse']['items'] == summary['save']['items'] == 2
+    assert summary['filing_download']['count'] == 2
+    assert summary['filing_download']['errors'] == 1
+    assert summary['filing_download']['bytes'] == 100
+    assert summary['parse']['latency_histogram']['+Inf'] == 1
+    assert summary['parse']['items_per_sec'] > 0
+
+
+def test_cli_metrics_and_profile(tmpdir, monkeypatch):
+    work_dir = str(tmpdir.join('edgar'))
+    ix = indexer.SecIndexer(work_dir)
+    write_feed(os.path.join(ix.feed_dir, 'xbrlrss-2016-02.xml'), [INTC_10K])
+    monkeypatch.setattr('sys.argv', [
+        'sec_edgar_download', 'ingest', '--wd', work_dir, '--jobs', '1',
+        '--metrics', str(tmpdir.join('edgar.prom')),
+        '--profile', str(tmpdir.join('ingest.prof'))])
+    cli.main()
+    assert len(read_feeds(ix)) == 1
+    prom = tmpdir.join('edgar.prom').read()
+    assert 'sec_edgar_download_stage_items_total{stage="save"} 1' in prom
+    assert ('sec_edgar_download_stage_seconds_bucket{stage="parse",le="+Inf"}'
+            ' 1') in prom
+    assert tmpdir.join('ingest.prof').size() > 0
+
+
+def test_download_sec_feeds_pipeline(tmpdir, edgar_server, monkeypatch):
+    feed = write_feed(tmpdir.join('feed.xml'), [INTC_10K])
+    for month in range(1, 13):
+        edgar_server.add_feed(2016, month, open(feed, 'rb').read())
+    edgar_server.latency = 0.1
+    ix = indexer.SecIndexer(str(tmpdir.join('edgar')),
+                            base_url=edgar_server.base_url)
+    # The (start, end) times of each stage, keyed by stage and month
+    runs = {}
+    downloaded = []
+
+    def timed(stage, month, func, *args):
+        start = time.monotonic()
+        result = func(*args)
+        runs[stage, month] = (start, time.monotonic())
+        return result
+
+    def feed_month(feed_file):
+        return int(os.path.basename(feed_file)[13:15])
+
+    download_sec_feed = ix._download_sec_feed
+
+    def parse_sec_rss_rows(feed_file):
+        return timed('parse', feed_month(feed_file), time.sleep, 0.1)
+
+    def save_feed(feed_file, state, rows):
+        downloaded.append(len(edgar_server.requests))
+        timed('save', feed_month(feed_file), time.sleep, 0.1)
+
+    monkeypatch.setattr(ix, '_download_sec_feed',
+                        lambda year, month, refresh: timed(
+                            'download', month, download_sec_feed, year,
+                            month, refresh))
+    monkeypatch.setattr(ix, 'parse_sec_rss_rows', parse_sec_rss_rows)
+    monkeypatch.setattr(ix, '_save_feed', save_feed)
+    ix.download_sec_feeds(2016, 2016, 1, 12, jobs=1)
+    assert len(downloaded) == 12
+
+    def overlap(first, second):
+        return (runs[first][0] < runs[second][1] and
+                runs[second][0] < runs[first][1])
+
+    # The stages overlap: a month is parsed while the next downloads and
+    # saved while the next is parsed, rather than one after another
+    assert any(overlap(('parse', month), ('download', month + 1))
+               for month in range(1, 12))
+    assert any(overlap(('save', month), ('parse', month + 1))
+               for month in range(1, 12))
+    # and the downloads are held no more than a few months ahead
+    assert downloaded[0] <= 6
+
+
+def test_cli_imports_are_light():
+    times = bench_import.import_times('sec_edgar_download.cli')
+    assert 'sec_edgar_download.indexer' in times
+    assert bench_import.heavy_imports(times) == []